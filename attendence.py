@@ -1,20 +1,25 @@
 import logging
 import functools
 import dataclasses
-from typing import Callable, Any
+from typing import Callable, Any, TypeVar
 
+from base import Base
 from user import User
 from team import Team
 from talk import Talk
 from report import Report
 from error import TalkInterrupt, UserInputError
-from response import RespText
+from response import RespText, RespChoice, iterPages, max_messages, max_text_length
 from question import Question, QType
+from notify import notifier
+from metrics import metrics
 import settings
 
 # can this import be removed from here
 from linebot.models import TextSendMessage  # type: ignore
 
+T = TypeVar("T")
+
 
 @dataclasses.dataclass
 class Context:
@@ -32,27 +37,24 @@ class Context:
         key_q = "question-" + prefix + key
         return Question(**self.talk.get(key_q))
 
-    def ask(self, question: Question, prefix: str = "", clear: bool = False) -> str:
+    def answered(self, key: str, prefix: str = "", clear: bool = False) -> str | None:
         """
-        Ask user additional things inside the command.
+        The answer of the asked question.
 
-        It will save current user's response (state)
-        and raise Error to interupt.
-        At the next message, it will continue the user's state,
-        and continue the command function.
-        The message is the answer of the question and will checked and
-        returned.
+        If the question is waiting for the answer,
+        the message is checked by the saved question and returned.
+        None if the question is not asked yet.
         """
         talk = self.talk
-        key_q = "question-" + prefix + question.key
-        key_a = "answer-" + prefix + question.key
+        key_q = "question-" + prefix + key
+        key_a = "answer-" + prefix + key
 
         answer = talk.get(key_a)
         if answer:
             return str(answer)
 
         if talk.get(key_q):
-            question = self.getQuestion(question.key, prefix)
+            question = self.getQuestion(key, prefix)
             result = question.checkResult(self.text)
             talk.set(key_a, result)
             if clear:
@@ -60,12 +62,44 @@ class Context:
                 talk.set(key_a, None)
             talk.save()
             return result
+        return None
 
-        talk.set(key_q, dataclasses.asdict(question))
-        talk.save()
+    def ask(self, question: Question, prefix: str = "", clear: bool = False) -> str:
+        """
+        Ask user additional things inside the command.
+
+        It will save current user's response (state)
+        and raise Error to interupt.
+        At the next message, it will continue the user's state,
+        and continue the command function.
+        The message is the answer of the question and will checked and
+        returned.
+        """
+        answer = self.answered(question.key, prefix, clear)
+        if answer is not None:
+            return answer
+
+        self.talk.set("question-" + prefix + question.key, dataclasses.asdict(question))
+        self.talk.save()
         resp = question.toResponse()
         raise TalkInterrupt(resp)
 
+    def step(self, key: str, func: Callable[[], T]) -> T:
+        """
+        Run the step of the command only once.
+
+        The result is saved in talk,
+        so the finished steps are not re-run (no DB access) when
+        the command is continued at the next message.
+        The result should be json serializable.
+        """
+        key_s = "step-" + key
+        if key_s in self.talk.talk:
+            return self.talk.get(key_s)  # type: ignore
+        result = func()
+        self.talk.set(key_s, result)
+        return result
+
     def askMany(self, questions: list[Question], prefix: str = "") -> dict[str, str]:
         """Same as ask() but ask more questions at once"""
         result = {}
@@ -106,13 +140,27 @@ class Context:
         user.updateProfile(profile.as_json_dict())
 
     def notifyReportAll(self, report: Report, text: str) -> None:
-        """Notify all users in the team of the report"""
+        """
+        Notify all users in the team of the report (in background).
+        The users are read from the member index (no member is loaded).
+        """
         if not self.line_bot_api:
             return
         team = Team(report.getTeam())
-        users = team.listUsers()
-        line_ids = [user["line"] for user in users]
-        self.line_bot_api.multicast(line_ids, TextSendMessage(text=text))
+        line_ids = [User.from_id(user_id).line for user_id in team.listUserIds()]
+        notifier.multicast(self.line_bot_api, line_ids, TextSendMessage(text=text))
+
+    def notifyReportPending(self, report: Report, text: str) -> int:
+        """
+        Notify the users not responded to the report yet (in background)
+        and return the number of them.
+        The users are read from the pending set (no member is loaded).
+        """
+        line_ids = [User.from_id(user_id).line for user_id in report.listPending()]
+        if self.line_bot_api and line_ids:
+            message = TextSendMessage(text=text)
+            notifier.multicast(self.line_bot_api, line_ids, message)
+        return len(line_ids)
 
 
 CommandFuncType = Callable[[User, Context], RespText]
@@ -127,6 +175,7 @@ class App:
     """
 
     logger = logging.getLogger("attendence.app")
+    next_page = "下一頁"
 
     def __init__(self) -> None:
         self.command_keyword: dict[str, CommandFuncType] = {}
@@ -163,6 +212,13 @@ class App:
         3. handle error message
         """
         self.logger.debug(f"{line_id}: {text}")
+        with metrics.request(), Base.unitOfWork():
+            return self.handleCommand(line_id, text, event, line_bot_api)
+
+    def handleCommand(
+        self, line_id: str, text: str, event: Any = None, line_bot_api: Any = None
+    ) -> RespText:
+        """Run the command (or continue the talk) of the message"""
         user = User(line_id)
         talk = Talk(line_id)
         context = Context(
@@ -172,6 +228,13 @@ class App:
             line_bot_api=line_bot_api,
         )
         try:
+            # the pages left by the last command
+            if talk.keyword == self.next_page:
+                pages = talk.get("pages")
+                talk.clear()
+                if text == self.next_page:
+                    metrics.setCommand(self.next_page)
+                    return self.paginate(RespText(pages[0], more=pages[1:]), talk)
             # continue talk state
             if talk:
                 keyword = talk.keyword
@@ -181,20 +244,43 @@ class App:
 
             # keyword trigger
             if keyword in self.command_keyword:
+                metrics.setCommand(keyword)
                 talk.set("keyword", keyword)
                 result = self.command_keyword[keyword](user, context)
                 # success command, clear key
                 context.talk.clear()
                 self.logger.debug(f"bot: {result}")
-                return result
+                return self.paginate(result, talk)
             # error
             return RespText("Error")
         except TalkInterrupt as e:
             self.logger.debug(f"bot: ask {e.resp}")
-            return e.resp
+            return self.paginate(e.resp)
         except UserInputError as e:
             self.logger.debug(f"Error: {e.args[0]}")
             context.talk.clear()
             if settings.mode == "test":
                 raise e
             return RespText(e.args[0])
+
+    def paginate(self, resp: RespText, talk: Talk | None = None) -> RespText:
+        """
+        Keep the response in the limit of a LINE reply.
+
+        The long text is split into messages,
+        the messages over the limit are saved in talk and
+        sent when user choose next page.
+        (Without talk, e.g. asking question, the messages are cut)
+        """
+        texts = [page for text in resp.texts for page in iterPages([text])] or [""]
+        if len(texts) <= max_messages:
+            return dataclasses.replace(resp, text=texts[0], more=texts[1:])
+        if talk is None:
+            texts = texts[:max_messages]
+            texts[-1] = texts[-1][: max_text_length - 4] + "\n..."
+            return dataclasses.replace(resp, text=texts[0], more=texts[1:])
+        talk.set("keyword", self.next_page)
+        talk.set("pages", texts[max_messages:])
+        talk.save()
+        texts = texts[:max_messages]
+        return RespChoice(texts[0], more=texts[1:], choices=[self.next_page])
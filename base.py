@@ -1,5 +1,43 @@
-from typing import Self, Any
-from db import db_instance
+from typing import Self, Any, Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from db import db_instance, setPath
+from error import InternalError
+
+
+@dataclass
+class UnitOfWork:
+    """
+    Identity map and pending writes of one handled message.
+
+    Every key is loaded from DB at most once,
+    and the saved objects are written back by one db.setsIf at the end
+    (compare-and-set by the versions when they were loaded).
+    """
+
+    objects: dict[str, Any] = field(default_factory=dict)
+    dirty: dict[str, Any] = field(default_factory=dict)
+    versions: dict[str, int] = field(default_factory=dict)  # of dirty ones in DB
+
+    def write(self, key: str) -> None:
+        """Write the saved object now (before the field of it is updated)"""
+        if key not in self.dirty:
+            return
+        if not db_instance.setIf(key, self.dirty.pop(key), self.versions.pop(key)):
+            raise InternalError(f"{key} is saved by others meanwhile")
+
+    def flush(self) -> None:
+        """Write all the saved objects if none of them is saved by others"""
+        if not self.dirty:
+            return
+        items = [(key, value, self.versions[key]) for key, value in self.dirty.items()]
+        self.dirty, self.versions = {}, {}
+        if not db_instance.setsIf(items):
+            raise InternalError(f"{[item[0] for item in items]} are saved by others")
+
+
+unit_of_work: ContextVar[UnitOfWork | None] = ContextVar("unit_of_work", default=None)
 
 
 class Base:
@@ -8,10 +46,10 @@ class Base:
     """
 
     db = db_instance
+    retry = 10  # times of atomicUpdate when the object is modified by others
 
     def __init__(self, key: str):
         self.id = key
-        self.lock: Any = None  # Redlock object if db is redis
         self._object: Any = None
         self._default: Any = None
 
@@ -22,19 +60,70 @@ class Base:
 
     @classmethod
     def newObject(cls, prefix: str, data: Any) -> Self:
-        """Create method"""
-        obj = cls(cls.db.create(prefix))
+        """Create method (saved to DB at once)"""
+        obj = cls(cls.db.createWith(prefix, data))
         obj._object = data
-        obj._object["id"] = obj.id
+        work = unit_of_work.get()
+        if work is not None:
+            work.objects[obj.id] = obj._object
         return obj
 
+    @classmethod
+    def loadMany(cls, objects: list[Self]) -> list[Self]:
+        """Load the objects (not loaded yet) by one db.gets"""
+        work = unit_of_work.get()
+        objects_to_load = [
+            obj
+            for obj in objects
+            if obj._object is None and (work is None or obj.id not in work.objects)
+        ]
+        values = cls.db.gets([obj.id for obj in objects_to_load])
+        for obj, value in zip(objects_to_load, values):
+            obj._object = value if value is not None else obj._default
+            if work is not None:
+                work.objects[obj.id] = obj._object
+        return objects
+
+    @classmethod
+    @contextmanager
+    def unitOfWork(cls) -> Iterator[UnitOfWork]:
+        """
+        Share the loaded objects and defer save() inside the block.
+
+        Use case:
+        ```
+        with Base.unitOfWork():
+            Team(team_id)["name"]  # query DB
+            Team(team_id)["name"]  # from identity map
+        ```
+        """
+        work = UnitOfWork()
+        token = unit_of_work.set(work)
+        try:
+            yield work
+        finally:
+            unit_of_work.reset(token)
+            work.flush()
+
+    def fetch(self) -> Any:
+        """Query DB (ignore identity map) and init data if requires creation"""
+        value = self.db.get(self.id)
+        if value is None:
+            value = self._default
+        work = unit_of_work.get()
+        if work is not None:
+            work.objects[self.id] = value
+        return value
+
     @property
     def object(self) -> Any:
         """Query DB if _object is None and init data if requires creation"""
         if self._object is None:
-            self._object = self.db.get(self.id)
-        if self._object is None:
-            self._object = self._default
+            work = unit_of_work.get()
+            if work is not None and self.id in work.objects:
+                self._object = work.objects[self.id]
+            else:
+                self._object = self.fetch()
         return self._object
 
     def __bool__(self) -> bool:
@@ -50,14 +139,62 @@ class Base:
         self.object[ind] = value
 
     def save(self) -> None:
-        """Save to DB"""
+        """
+        Save to DB (deferred to the end of unitOfWork)
+        if no one else saved it since it was loaded (compare the version),
+        otherwise raise InternalError.
+        Use atomicUpdate to apply the change again instead of raising.
+        """
         assert self._object
-        self.db.set(self.id, self._object)
-        if self.lock and self.db.isLock(self.lock):
-            self.db.release(self.lock)
-        self.lock = None
-
-    def block(self) -> None:
-        """Block team to be written and give the latest team"""
-        self.lock = self.db.lock(self.id)
-        self._object = None
+        version = self._object.get("_version", 0)
+        self._object["_version"] = version + 1
+        work = unit_of_work.get()
+        if work is not None:
+            if self.id not in work.dirty:
+                work.versions[self.id] = version
+            work.objects[self.id] = self._object
+            work.dirty[self.id] = self._object
+            return
+        if not self.db.setIf(self.id, self._object, version):
+            raise InternalError(f"{self.id} is saved by others meanwhile")
+
+    def update(self, path: list[str], value: Any) -> None:
+        """
+        Set one field of the object and write only this field to DB.
+
+        Use case:
+        ```
+        team.update(["reports", report_id, "end"], True)
+        ```
+        """
+        work = unit_of_work.get()
+        if work is not None:
+            work.write(self.id)
+        setPath(self.object, path, value)
+        self._object["_version"] = self._object.get("_version", 0) + 1
+        self.db.update(self.id, path, value)
+
+    def atomicUpdate(self, func: Callable[[Self], None]) -> None:
+        """
+        Modify the object by func and save it if no one else saved it meanwhile
+        (compare the version of document).
+        Otherwise, load the latest object and apply func again.
+
+        Use case:
+        ```
+        team.atomicUpdate(lambda team: team.join(user, admin=False))
+        ```
+        """
+        work = unit_of_work.get()
+        if work is not None:
+            work.write(self.id)
+        for _ in range(self.retry):
+            version = self.object.get("_version", 0)
+            func(self)
+            self._object["_version"] = version + 1
+            if self.db.setIf(self.id, self._object, version):
+                if work is not None:
+                    work.objects[self.id] = self._object
+                return
+            self._object = self.fetch()
+        raise InternalError(f"Too many conflicts when saving {self.id}")
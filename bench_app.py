@@ -0,0 +1,174 @@
+"""
+Benchmark of the commands (`command.app.handle`) on a storage backend.
+
+The teams are created, the members join, the admins create reports
+and the members response to them, then the time of every message and
+the DB operations of every command are reported per command:
+messages/s, p50/p99 latency (ms) of a message and DB operations per command.
+
+The backend:
+* object: KVData
+* redis: `settings.redis_url` (e.g. a local redis-server) or fakeredis by --fake
+* dynamodb: boto3 endpoint (e.g. DynamoDB local by AWS_ENDPOINT_URL)
+  or moto by --fake
+
+The database is CLEARED before running, like the tests,
+so the real redis/dynamodb runs only with --i-know-this-wipes.
+
+Usage: `python bench_app.py object --teams 2 --members 100 --reports 3`
+"""
+import os
+import time
+import argparse
+import statistics
+from typing import Any, Callable
+from collections import defaultdict
+
+import settings
+
+
+class Bench:
+    """Send the messages and record the latency and DB operations per command"""
+
+    def __init__(self, app: Any, db: Any):
+        self.app = app
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.operations: dict[str, list[int]] = defaultdict(list)
+        self.count = 0
+        self.depth = 0  # the operations called inside an operation are not counted
+        from db import LazyDB
+
+        for name in LazyDB.operations:  # the interface of all backends
+            if hasattr(db, name):
+                setattr(db, name, self.counted(getattr(db, name)))
+
+    def counted(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        """Count the calls of the DB operation"""
+
+        def wrap(*args: Any, **kwargs: Any) -> Any:
+            self.count += self.depth == 0
+            self.depth += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.depth -= 1
+
+        return wrap
+
+    def run(self, command: str, line_id: str, answers: list[Any]) -> Any:
+        """
+        Run the command with the answers of the questions.
+        The answer is the text or a function to choose from the response.
+        """
+        self.count = 0
+        resp = self.send(command, line_id, command)
+        for answer in answers:
+            text = answer(resp) if callable(answer) else answer
+            resp = self.send(command, line_id, text)
+        self.operations[command].append(self.count)
+        return resp
+
+    def send(self, command: str, line_id: str, text: str) -> Any:
+        """Send one message"""
+        start = time.perf_counter()
+        resp = self.app.handle(line_id, text)
+        self.latency[command].append(time.perf_counter() - start)
+        return resp
+
+    def report(self) -> None:
+        """Print the result per command"""
+        print(
+            f"{'command':18} {'msgs':>6} {'msgs/s':>8} {'p50(ms)':>8} "
+            f"{'p99(ms)':>8} {'ops/cmd':>8}"
+        )
+        for command, times in self.latency.items():
+            times = sorted(times)
+            p50 = statistics.median(times) * 1000
+            p99 = times[min(len(times) - 1, int(len(times) * 0.99))] * 1000
+            ops = statistics.mean(self.operations[command])
+            print(
+                f"{command:18} {len(times):6d} {len(times) / sum(times):8.1f} "
+                f"{p50:8.2f} {p99:8.2f} {ops:8.1f}"
+            )
+
+
+def choose(name: str) -> Callable[[Any], str]:
+    """Choose the option of the name (e.g. '(2) name')"""
+
+    def wrap(resp: Any) -> str:
+        choices = getattr(resp, "choices", [])
+        return next(choice for choice in choices if choice.endswith(" " + name))
+
+    return wrap
+
+
+def main(args: argparse.Namespace) -> None:
+    """Build the data by the commands and print the result"""
+    from command import app
+    from db import db_instance
+
+    bench = Bench(app, db_instance.load())
+    for t in range(args.teams):
+        admin = f"admin{t:03d}"
+        team = f"team{t:03d}"
+        resp = bench.run("create team", admin, [team, "學號", "結束"])
+        token = resp.text.split("加入token: ")[1].split()[0]
+        for m in range(args.members):
+            bench.run("join team", f"member{t:03d}-{m:05d}", [token, str(m)])
+        for r in range(args.reports):
+            bench.run("create report", admin, [f"{team}-{r}", "地點", "結束"])
+
+    for t in range(args.teams):
+        for r in range(args.reports):
+            report = f"team{t:03d}-{r}"
+            for m in range(min(args.responses, args.members)):
+                answers = [choose(report)] if args.reports > 1 else []
+                bench.run(
+                    "response report", f"member{t:03d}-{m:05d}", answers + ["home"]
+                )
+        answers = [choose(f"team{t:03d}-0")] if args.reports > 1 else []
+        bench.run("inspect report", f"admin{t:03d}", answers + ["全部"])
+        bench.run("list member", f"admin{t:03d}", [])
+    bench.report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("backend", choices=["object", "redis", "dynamodb"])
+    parser.add_argument("--teams", type=int, default=2)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--reports", type=int, default=2)
+    parser.add_argument("--responses", type=int, default=50, help="per report")
+    parser.add_argument("--fake", action="store_true", help="fakeredis or moto")
+    parser.add_argument(
+        "--i-know-this-wipes",
+        action="store_true",
+        help="run on the real redis/dynamodb of settings.py (ALL DATA IS DELETED)",
+    )
+    args = parser.parse_args()
+    if args.backend != "object" and not args.fake and not args.i_know_this_wipes:
+        parser.error(
+            f"{args.backend} of settings.py is cleared, "
+            "use --fake or --i-know-this-wipes"
+        )
+
+    settings.mode = "test"  # clear the database
+    settings.db = args.backend
+    settings.logger.setLevel("WARNING")
+    settings.notify_workers = 0
+    if args.fake and args.backend == "redis":
+        import fakeredis
+        from redis import Redis
+
+        server = fakeredis.FakeServer()
+        Redis.from_url = lambda *_, **kwargs: fakeredis.FakeRedis(  # type: ignore
+            server=server, **kwargs
+        )
+    if args.backend == "dynamodb":
+        settings.dynamodb_provision = "verify"
+    if args.fake and args.backend == "dynamodb":
+        from moto import mock_aws
+
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        mock_aws().start()
+    main(args)
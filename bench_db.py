@@ -0,0 +1,68 @@
+"""
+Per-operation overhead of the debug log in the DB layer.
+
+Set and get a large Team-like document on the object backend with
+* off: the logger above DEBUG (production)
+* debug: DEBUG log without payload (the default settings)
+* payload: DEBUG log with `settings.db_log_payload` (development)
+
+Usage: `python bench_db.py [members] [repeat]`
+"""
+import os
+import sys
+import time
+import logging
+import statistics
+
+import settings
+from db import KVData
+
+
+def document(members: int) -> dict:
+    """A team document of the size of members"""
+    return {
+        "id": "team-bench",
+        "name": "bench",
+        "users": {
+            f"user-{i}": {"name": f"name{i}", "role": ["user"], "question": {}}
+            for i in range(members)
+        },
+        "reports": {},
+    }
+
+
+def measure(db: KVData, value: dict, repeat: int) -> float:
+    """Median time (us) of one set + get"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        db.set("team-bench", value)
+        db.get("team-bench")
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times) * 1e6
+
+
+def main(members: int = 500, repeat: int = 200) -> None:
+    """Print the time of set + get per logging mode"""
+    logger = logging.getLogger("attendence")
+    devnull = open(os.devnull, "w")
+    logger.handlers = [logging.StreamHandler(devnull)]
+    db = KVData()
+    value = document(members)
+
+    results = {}
+    logger.setLevel(logging.INFO)
+    results["off"] = measure(db, value, repeat)
+    logger.setLevel(logging.DEBUG)
+    settings.db_log_payload = False
+    results["debug"] = measure(db, value, repeat)
+    settings.db_log_payload = True
+    results["payload"] = measure(db, value, repeat)
+
+    print(f"{'logging':10} {'set+get (us)':>14}")
+    for name, cost in results.items():
+        print(f"{name:10} {cost:14.1f}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,54 @@
+"""
+Cold start benchmark of the storage backends.
+
+Every measurement runs in a fresh python process (like a new Lambda container)
+and reports the time of
+* import db: the app-wide import (no backend package should be loaded)
+* backend: importing the packages of the selected backend at its first use
+
+Usage: `python bench_startup.py [repeat]`
+"""
+import sys
+import json
+import statistics
+import subprocess
+
+from db import backends
+
+
+SCRIPT = """
+import sys, time, json, importlib
+t0 = time.perf_counter()
+import db
+t1 = time.perf_counter()
+for package in db.backends[{name!r}].__dict__.get("packages", []):
+    importlib.import_module(package)
+t2 = time.perf_counter()
+print(json.dumps({{"import db": t1 - t0, "backend": t2 - t1}}))
+"""
+
+
+def measure(name: str) -> dict[str, float]:
+    """Run one cold start of the backend in a new process"""
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(name=name)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])  # type: ignore
+
+
+def main(repeat: int = 5) -> None:
+    """Print the median cold start cost (ms) per backend"""
+    print(f"{'backend':10} {'import db':>10} {'backend':>10} {'total':>10}")
+    for name in backends:
+        results = [measure(name) for _ in range(repeat)]
+        import_db = statistics.median(r["import db"] for r in results) * 1000
+        backend = statistics.median(r["backend"] for r in results) * 1000
+        total = import_db + backend
+        print(f"{name:10} {import_db:10.1f} {backend:10.1f} {total:10.1f}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
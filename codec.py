@@ -0,0 +1,137 @@
+"""
+Encoding of the documents saved in DB.
+
+The first byte is the format (version) of the value:
+* (no header): plain orjson, saved before the codec
+* 0x01: orjson
+* 0x02: zlib of orjson with DICTIONARY
+* 0x03: zstd of orjson with DICTIONARY (`pip install zstandard`)
+
+The value is compressed (by settings.codec) only if the orjson is larger
+than settings.codec_threshold. Every format can always be decoded
+whatever settings.codec is, so it can be changed anytime.
+DICTIONARY must never be changed, add a new format with the new dictionary.
+"""
+import zlib
+import threading
+from typing import Any
+
+import orjson
+
+import settings
+
+PLAIN = b"\x01"
+ZLIB = b"\x02"
+ZSTD = b"\x03"
+
+# Preset dictionary from the shapes of our documents (user, team, report, member)
+# the common strings are put at the end (nearer is cheaper)
+DICTIONARY = b"".join(
+    orjson.dumps(sample)
+    for sample in [
+        {
+            "end": False,
+            "name": "",
+            "team": "team-",
+            "team_name": "",
+            "questions": [
+                {
+                    "q_type": "short",
+                    "key": "",
+                    "title": "",
+                    "description": "",
+                    "data": None,
+                }
+            ],
+            "id": "report-",
+            "_version": 1,
+        },
+        {
+            "name": "",
+            "join_questions": [
+                {
+                    "q_type": "short",
+                    "key": "",
+                    "title": "",
+                    "description": "",
+                    "data": None,
+                }
+            ],
+            "join_admin_token": "token-",
+            "join_user_token": "token-",
+            "reports": {},
+            "id": "team-",
+            "_version": 1,
+        },
+        {
+            "id": "member-team-",
+            "team": "team-",
+            "user": "user-",
+            "name": "",
+            "role": ["user"],
+            "question": {},
+            "leave": False,
+            "_version": 1,
+        },
+        {
+            "id": "user-",
+            "line": "",
+            "profile": {"displayName": "", "userId": "", "pictureUrl": ""},
+            "teams": {"team-": {"name": "", "id": "team-", "role": ["admin"]}},
+            "reports": {
+                "report-": {
+                    "team": "team-",
+                    "team_name": "",
+                    "name": "",
+                    "id": "report-",
+                    "end": False,
+                }
+            },
+            "_version": 1,
+        },
+    ]
+)
+
+
+def encode(value: Any) -> bytes:
+    """Data -> bytes (with the format header)"""
+    data = orjson.dumps(value)
+    if len(data) < settings.codec_threshold or settings.codec == "none":
+        return PLAIN + data
+    if settings.codec == "zstd":
+        return ZSTD + zstd().compressor.compress(data)
+    if settings.codec == "zlib":
+        compressor = zlib.compressobj(level=6, zdict=DICTIONARY)
+        return ZLIB + compressor.compress(data) + compressor.flush()
+    raise ValueError(f"Codec {settings.codec} not found")
+
+
+def decode(raw_value: bytes | str) -> Any:
+    """Bytes (any of the formats) -> data"""
+    if isinstance(raw_value, str):
+        raw_value = raw_value.encode()
+    header, data = raw_value[:1], raw_value[1:]
+    if header == PLAIN:
+        return orjson.loads(data)
+    if header == ZLIB:
+        decompressor = zlib.decompressobj(zdict=DICTIONARY)
+        return orjson.loads(decompressor.decompress(data) + decompressor.flush())
+    if header == ZSTD:
+        return orjson.loads(zstd().decompressor.decompress(data))
+    return orjson.loads(raw_value)  # plain orjson without header
+
+
+_zstd = threading.local()  # the (de)compressors are not thread safe
+
+
+def zstd() -> Any:
+    """The zstd (de)compressor with the dictionary (zstandard is imported here)"""
+    if not hasattr(_zstd, "compressor"):
+        import zstandard
+
+        dictionary = zstandard.ZstdCompressionDict(
+            DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+        )
+        _zstd.compressor = zstandard.ZstdCompressor(level=3, dict_data=dictionary)
+        _zstd.decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return _zstd
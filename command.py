@@ -1,3 +1,4 @@
+import dataclasses
 from typing import Callable, Any
 from datetime import datetime
 
@@ -16,24 +17,32 @@ app = App()
 
 def chooseTeam(context: Context, user: User, has_admin: bool = True) -> str:
     """Ask which user's team the user want to choose"""
-    question = user.generateTeamQuestion(has_admin=has_admin)
-    if not question.data:
-        raise UserInputError("你在你的團隊中都沒有管理員權限")
-        # raise UserInputError("You don't have admin in all of your team")
-    if len(question.data) == 1:
-        return next(iter(question.data.values()))
-    return context.ask(question)
+
+    def choose() -> str:
+        question = user.generateTeamQuestion(has_admin=has_admin)
+        if not question.data:
+            raise UserInputError("你在你的團隊中都沒有管理員權限")
+            # raise UserInputError("You don't have admin in all of your team")
+        if len(question.data) == 1:
+            return next(iter(question.data.values()))
+        return context.ask(question)
+
+    return context.step("team_id", lambda: context.answered("team_id") or choose())
 
 
 def chooseReport(context: Context, user: User, filter_end: bool = True) -> str:
     """Ask which user's report the user want to choose"""
-    question = user.generateReportQuestion(filter_end=filter_end)
-    if not question.data:
-        raise UserInputError("目前在你的團隊中都沒有需要回報的")
-        # raise UserInputError("You don't have any report in all of your team")
-    if len(question.data) == 1:
-        return next(iter(question.data.values()))
-    return context.ask(question)
+
+    def choose() -> str:
+        question = user.generateReportQuestion(filter_end=filter_end)
+        if not question.data:
+            raise UserInputError("目前在你的團隊中都沒有需要回報的")
+            # raise UserInputError("You don't have any report in all of your team")
+        if len(question.data) == 1:
+            return next(iter(question.data.values()))
+        return context.ask(question)
+
+    return context.step("report_id", lambda: context.answered("report_id") or choose())
 
 
 def userJoinTeam(user: User, team: Team, admin: bool, context: Context) -> None:
@@ -45,9 +54,7 @@ def userJoinTeam(user: User, team: Team, admin: bool, context: Context) -> None:
     user.join(team, admin=admin)
     context.updateUserProfile(user)
     user.save()
-    team.block()
     team.join(user, admin=admin, member_info=member_info)
-    team.save()
 
 
 @app.addCommand(keywords=["create team", "新增團隊"])
@@ -119,16 +126,20 @@ def kickMember(user: User, context: Context) -> RespText:
     """Command(Admin): Kick team member"""
     team_id = chooseTeam(context, user, has_admin=True)
     team = Team(team_id)
-    users = team.listUsers()
-    uid = context.ask(
-        Question(
-            q_type=QType.Short,
-            key="user_id",
-            title="請輸入編號",
-            description="\n".join(f"{i}. {u['name']}" for i, u in enumerate(users)),
-            data=users,  # type: ignore
+    uid = context.answered("user_id")
+    if uid is None:
+        users = team.listUsers()
+        uid = context.ask(
+            Question(
+                q_type=QType.Short,
+                key="user_id",
+                title="請輸入編號",
+                description="\n".join(
+                    f"{i}. {u['name']}" for i, u in enumerate(users)
+                ),
+                data=users,  # type: ignore
+            )
         )
-    )
     users = context.getQuestion("user_id").data  # type: ignore
     try:
         int(uid)
@@ -141,10 +152,8 @@ def kickMember(user: User, context: Context) -> RespText:
 
     user_id = users[int(uid) - 1]["id"]
     team.kickUser(user_id)
-    team.save()
-    kicked_user = User.from_id(user_id)
-    kicked_user.leaveTeam(team.id)
-    kicked_user.save()
+    # not the user of this message, may be saved by its own message meanwhile
+    User.from_id(user_id).atomicUpdate(lambda kicked: kicked.leaveTeam(team.id))
     return jsonToRespText({"踢除": User(user_id).getName()})
 
 
@@ -154,7 +163,6 @@ def leaveTeam(user: User, context: Context) -> RespText:
     team_id = chooseTeam(context, user, has_admin=False)
     team = Team(team_id)
     team.kickUser(user.id)
-    team.save()
     user.leaveTeam(team.id)
     user.save()
     return jsonToRespText({"離開": team.getName()})
@@ -185,9 +193,7 @@ def createReport(user: User, context: Context) -> RespText:
     questions = [createShortQuestion(text) for text in text_list]
     team = Team(team_id)
     report = Report.create(name=name, team=team, questions=questions)
-    report.save()
     team.addReport(report)
-    team.save()
     # updateUserForReport(team, report, status="start")
     context.notifyReportAll(report, f"{report['team_name']} ㄉ {report.getName()} 已開始")
     return jsonToRespText(
@@ -203,17 +209,16 @@ def responseReport(user: User, context: Context) -> RespText:
     """Command: User response the report"""
     report_id = chooseReport(context, user)
 
-    report = Report(report_id)
-    questions = report.generateQuestion()
-    result = context.askMany(questions, prefix="xxx-")
+    questions = context.step(
+        "questions",
+        lambda: [dataclasses.asdict(q) for q in Report(report_id).generateQuestion()],
+    )
+    result = context.askMany([Question(**q) for q in questions], prefix="xxx-")
     result["time"] = datetime.now()  # type: ignore
 
-    history = History(report.id, user.id)
-    history.addResponse(result)
-    history.save()
-    report.block()
+    report = Report(report_id)
+    History(report.id, user.id).addResponse(result)
     report.addResponse(user.id, result)
-    report.save()
     return jsonToRespText(
         {
             "回報": report["name"],
@@ -239,22 +244,24 @@ def inspectReport(user: User, context: Context) -> RespText:
         if filter_type == "all":
             pass
         elif filter_type == "include" or filter_type == "exclude":
-            report = Report(report_id)
-            team = Team(report.getTeam())
-            item = context.ask(
-                Question(
-                    q_type=QType.Choices,
-                    key="item",
-                    title="對象",
-                    data={
-                        q.title: q.title
-                        for q in (
-                            *report.generateQuestion(),
-                            *team.generateJoinQuestion(),
-                        )
-                    },
+            item = context.answered("item")
+            if item is None:
+                report = Report(report_id)
+                team = Team(report.getTeam())
+                item = context.ask(
+                    Question(
+                        q_type=QType.Choices,
+                        key="item",
+                        title="對象",
+                        data={
+                            q.title: q.title
+                            for q in (
+                                *report.generateQuestion(),
+                                *team.generateJoinQuestion(),
+                            )
+                        },
+                    )
                 )
-            )
             value = context.ask(createShortQuestion("值"))
             if filter_type == "include":
                 filter_func = lambda u: value in u.get(item, "")
@@ -265,15 +272,17 @@ def inspectReport(user: User, context: Context) -> RespText:
     report = Report(report_id)
     team = Team(report.getTeam())
     if user.hasAdminReport(report_id):
-        users_id = set(report["users"]) | set(i["id"] for i in team.listUsers())
+        users_id = set(report.listResponded()) | set(i["id"] for i in team.listUsers())
     else:
         # user inspect itself
         users_id = set([user.id])
+    responses = report.getResponses(list(users_id))
+    members = team.getUsers(list(users_id))
     users = [
         {
-            "line": team["users"][user_id]["name"],
-            **team.getMemberInfo(user_id),
-            **report.getMemberResponse(user_id),
+            "line": members[user_id]["name"],
+            **members[user_id]["question"],
+            **responses[user_id],
         }
         for user_id in users_id
     ]
@@ -282,6 +291,38 @@ def inspectReport(user: User, context: Context) -> RespText:
     return jsonToRespText(list(users))
 
 
+@app.addCommand(keywords=["report status", "回報狀態"])
+def reportStatus(user: User, context: Context) -> RespText:
+    """Command(Admin): The number of responded members and who not responded yet"""
+    report_id = chooseReport(context, user)
+    if not user.hasAdminReport(report_id):
+        raise UserInputError("You are not admin of the report")
+    report = Report(report_id)
+    stats = report.getStats()
+    pending = Team(report.getTeam()).getUsers(report.listPending())
+    return jsonToRespText(
+        {
+            "回報": report.getName(),
+            "已回報": stats["responded"],
+            "未回報": stats["pending"],
+            "未回報成員": sorted(member["name"] for member in pending.values()),
+        }
+    )
+
+
+@app.addCommand(keywords=["remind report", "提醒回報"])
+def remindReport(user: User, context: Context) -> RespText:
+    """Command(Admin): Remind the members not responded yet"""
+    report_id = chooseReport(context, user)
+    if not user.hasAdminReport(report_id):
+        raise UserInputError("You are not admin of the report")
+    report = Report(report_id)
+    count = context.notifyReportPending(
+        report, f"{report['team_name']} ㄉ {report.getName()} 還沒回報喔"
+    )
+    return jsonToRespText({"提醒": report.getName(), "未回報": count})
+
+
 @app.addCommand(keywords=["end report", "結束回報"])
 def endReport(user: User, context: Context) -> RespText:
     """Command(Admin):  Stop user from responsing to report"""
@@ -289,12 +330,12 @@ def endReport(user: User, context: Context) -> RespText:
     if not user.hasAdminReport(report_id):
         raise UserInputError("You are not admin of the report")
     report = Report(report_id)
-    report.end()
-    report.save()
+    report.atomicUpdate(lambda report: report.end())
 
     team = Team(report.getTeam())
     team.endReport(report.id)
-    team.save()
     # updateUserForReport(team, report, status="end")
-    context.notifyReportAll(report, f"{report['team_name']} ㄉ {report.getName()} 已結束")
+    context.notifyReportAll(
+        report, f"{report['team_name']} ㄉ {report.getName()} 已結束"
+    )
     return RespText(f"{report.getName()} 已結束")
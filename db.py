@@ -1,41 +1,137 @@
-from typing import Any
-from pprint import pformat
-from datetime import timedelta
+from typing import Any, Callable, Iterator
+from decimal import Decimal
+from collections import defaultdict, deque, OrderedDict
+import json
 import uuid
+import time
 import logging
+import threading
 
-# for redis
-from pottery import Redlock
-from redis import Redis
 import orjson
 
-# for dynamodb
-import boto3
-from python_dynamodb_lock.python_dynamodb_lock import DynamoDBLockClient, DynamoDBLock
-
 import settings
+from codec import encode, decode
+from error import InternalError
+
+# The packages of redis and dynamodb are imported when the backend is used
+backends: dict[str, type] = {}
+
+
+class Payload:
+    """
+    The value in the debug log, formatted only when the log is emitted.
+
+    The value is dumped only if `settings.db_log_payload`
+    (cut at `settings.db_log_payload_max` characters),
+    otherwise only its type and size are shown.
+    """
+
+    __slots__ = ("value", "keys_only")
+
+    def __init__(self, value: Any, keys_only: bool = False):
+        self.value = value
+        self.keys_only = keys_only  # value is a list of (key, value, ...)
+
+    def __str__(self) -> str:
+        if self.keys_only:
+            return str([item[0] for item in self.value])
+        if not settings.db_log_payload:
+            size = f" len={len(self.value)}" if hasattr(self.value, "__len__") else ""
+            return f"<{type(self.value).__name__}{size}>"
+        text = orjson.dumps(
+            self.value,
+            default=str,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS,
+        ).decode()
+        if len(text) > settings.db_log_payload_max:
+            text = text[: settings.db_log_payload_max] + f"... ({len(text)} chars)"
+        return text
+
+
+def versionOf(value: Any) -> int:
+    """
+    The version of the document (0 if not exists or not versioned).
+    It increases at every Base.save() for optimistic concurrency.
+    """
+    if isinstance(value, dict):
+        return int(value.get("_version", 0))
+    return 0
+
 
+def setPath(value: Any, path: list[str], field: Any) -> None:
+    """value[path[0]][path[1]]... = field (the missing parents are created)"""
+    for name in path[:-1]:
+        value = value.setdefault(name, {})
+    value[path[-1]] = field
 
+
+def updateByVersion(
+    db: Any, key: str, path: list[str], field: Any, retry: int = 10
+) -> None:
+    """Field-level update by read, modify and compare-and-set the whole data"""
+    for _ in range(retry):
+        value = db.get(key) or {}
+        version = versionOf(value)
+        setPath(value, path, field)
+        value["_version"] = version + 1
+        if db.setIf(key, value, version):
+            return
+    raise InternalError(f"Too many conflicts when updating {key}")
+
+
+def registerBackend(name: str) -> Callable[[type], type]:
+    """Register the storage class as an option of settings.db"""
+
+    def wrap(cls: type) -> type:
+        backends[name] = cls
+        return cls
+
+    return wrap
+
+
+@registerBackend("object")
 class KVData:
     """
     A key-value storage interface
     """
 
     logger = logging.getLogger("attendence.db")
+    max_claims = 10000
 
     def __init__(self) -> None:
-        self.data: dict[str, Any] = {}
+        # serialized like other backends, so the objects are not shared
+        self.data: dict[str, bytes] = {}
+        self.hashes: dict[str, dict[str, bytes]] = {}
+        self.expires: dict[str, float] = {}
+        self.claims: OrderedDict[str, float] = OrderedDict()  # LRU of key: expiry
+        self.queues: defaultdict[str, deque[bytes]] = defaultdict(deque)
+        self.lists: dict[str, list[bytes]] = {}
+        self.members: dict[str, set[str]] = {}
+        self.queue_condition = threading.Condition()
 
     def get(self, key: str, default: Any | None = None) -> Any:
         """Get Data by key"""
-        value = self.data.get(key, default)
-        self.logger.debug(f"Get {key}={value}")
+        raw_value = self.data.get(key)
+        value = decode(raw_value) if raw_value else default
+        self.logger.debug("Get %s=%s", key, Payload(value))
         return value
 
     def set(self, key: str, value: Any) -> None:
         """Set data by key"""
-        self.logger.debug(f"Set {key}={pformat(value)}")
-        self.data[key] = value
+        self.logger.debug("Set %s=%s", key, Payload(value))
+        self.data[key] = encode(value)
+
+    def setIf(self, key: str, value: Any, version: int) -> bool:
+        """Set data by key if the version of stored data is not changed"""
+        if versionOf(self.get(key)) != version:
+            self.logger.debug("Conflict %s version=%s", key, version)
+            return False
+        self.set(key, value)
+        return True
+
+    def update(self, key: str, path: list[str], value: Any) -> None:
+        """Set the field (by path) of the data"""
+        updateByVersion(self, key, path, value)
 
     def gets(self, keys: list[str]) -> list[Any]:
         """Get Data by keys"""
@@ -46,175 +142,462 @@ class KVData:
         for key, value in key_values:
             self.set(key, value)
 
+    def setsIf(self, items: list[tuple[str, Any, int]]) -> bool:
+        """Set data by keys if none of the versions of stored data are changed"""
+        for key, _, version in items:
+            if versionOf(self.get(key)) != version:
+                self.logger.debug("Conflict %s version=%s", key, version)
+                return False
+        for key, value, _ in items:
+            self.set(key, value)
+        return True
+
+    def hash(self, key: str) -> dict[str, bytes]:
+        """The hash of the key (removed if expired)"""
+        if self.expires.get(key, float("inf")) < time.time():
+            self.hashes.pop(key, None)
+            del self.expires[key]
+        return self.hashes.setdefault(key, {})
+
+    def hset(self, key: str, field: str, value: Any) -> None:
+        """Set the field of hash"""
+        self.logger.debug("Hset %s %s=%s", key, field, Payload(value))
+        self.hash(key)[field] = orjson.dumps(value)
+
+    def hsets(self, key: str, values: dict[str, Any], ttl: int | None = None) -> None:
+        """Set the fields of hash (delete the field if None) and the expiry"""
+        self.logger.debug("Hsets %s=%s", key, Payload(values))
+        hash_value = self.hash(key)
+        for field, value in values.items():
+            if value is None:
+                hash_value.pop(field, None)
+            else:
+                hash_value[field] = orjson.dumps(value)
+        if ttl:
+            self.expires[key] = time.time() + ttl
+
+    def hget(self, key: str, field: str, default: Any | None = None) -> Any:
+        """Get the field of hash"""
+        raw_value = self.hash(key).get(field)
+        return orjson.loads(raw_value) if raw_value else default
+
+    def hgetall(self, key: str) -> dict[str, Any]:
+        """Get all the fields and values of hash"""
+        return {
+            field: orjson.loads(raw_value)
+            for field, raw_value in self.hash(key).items()
+        }
+
+    def hkeys(self, key: str) -> list[str]:
+        """Get all the fields of hash"""
+        return list(self.hash(key))
+
+    def hdel(self, key: str, field: str) -> None:
+        """Delete the field of hash"""
+        self.logger.debug("Hdel %s %s", key, field)
+        self.hash(key).pop(field, None)
+
+    def append(self, key: str, value: Any) -> None:
+        """Append the value to the list"""
+        self.logger.debug("Append %s %s", key, Payload(value))
+        self.lists.setdefault(key, []).append(orjson.dumps(value))
+
+    def lrange(self, key: str, start: int = 0, count: int | None = None) -> list[Any]:
+        """Get count values of the list from start"""
+        values = self.lists.get(key, [])
+        end = None if count is None else start + count
+        return [orjson.loads(value) for value in values[start:end]]
+
+    def llen(self, key: str) -> int:
+        """The length of the list"""
+        return len(self.lists.get(key, []))
+
+    def sadd(self, key: str, members: list[str]) -> None:
+        """Add the members to the set"""
+        self.logger.debug("Sadd %s %s", key, Payload(members))
+        self.members.setdefault(key, set()).update(members)
+
+    def srem(self, key: str, members: list[str]) -> None:
+        """Remove the members from the set"""
+        self.logger.debug("Srem %s %s", key, Payload(members))
+        self.members.get(key, set()).difference_update(members)
+
+    def smembers(self, key: str) -> list[str]:
+        """Get all the members of the set"""
+        return list(self.members.get(key, set()))
+
+    def scard(self, key: str) -> int:
+        """The number of members in the set"""
+        return len(self.members.get(key, set()))
+
+    def push(self, key: str, value: Any) -> None:
+        """Append the value to the queue"""
+        with self.queue_condition:
+            self.queues[key].append(orjson.dumps(value))
+            self.queue_condition.notify()
+
+    def pop(self, key: str, timeout: float = 1, processing: str | None = None) -> Any:
+        """
+        Pop the first value of the queue (wait until timeout if empty)
+        and keep it in the processing queue until ack (if given)
+        """
+        with self.queue_condition:
+            if not self.queue_condition.wait_for(lambda: self.queues[key], timeout):
+                return None
+            raw_value = self.queues[key].popleft()
+            if processing:
+                self.queues[processing].append(raw_value)
+            return orjson.loads(raw_value)
+
+    def ack(self, processing: str, value: Any) -> None:
+        """Remove the handled value from the processing queue"""
+        with self.queue_condition:
+            try:
+                self.queues[processing].remove(orjson.dumps(value))
+            except ValueError:
+                pass
+
+    def requeue(self, processing: str, key: str) -> int:
+        """Move the values in processing queue back to the front of the queue"""
+        with self.queue_condition:
+            values = self.queues.pop(processing, deque())
+            self.queues[key].extendleft(reversed(values))
+            self.queue_condition.notify_all()
+            return len(values)
+
+    def claim(self, key: str, ttl: int) -> bool:
+        """Mark the key for ttl seconds, False if it is marked already"""
+        now = time.time()
+        if self.claims.get(key, 0) > now:
+            return False
+        self.claims[key] = now + ttl
+        self.claims.move_to_end(key)
+        while len(self.claims) > self.max_claims:
+            self.claims.popitem(last=False)
+        return True
+
     def delete(self, key: str) -> None:
         """Delete key"""
-        self.logger.debug(f"Delete {key}")
-        del self.data[key]
+        self.logger.debug("Delete %s", key)
+        self.hashes.pop(key, None)
+        self.expires.pop(key, None)
+        self.claims.pop(key, None)
+        self.lists.pop(key, None)
+        self.members.pop(key, None)
+        self.data.pop(key, None)
 
-    def create(self, prefix: str) -> str:
-        """Find a random and unused key"""
+    def createWith(self, prefix: str, value: Any) -> str:
+        """Save the value at a random and unused key (saved in value["id"])"""
         while True:
             key = prefix + str(uuid.uuid4())
-            if not self.get(key):
+            if key not in self.data:
                 break
+        value["id"] = key
+        self.set(key, value)
         return key
 
     def clear(self) -> None:
         """Remove all data"""
         self.data = {}
-
-    def lock(self, key: str) -> None:
-        """Not implement"""
-
-    @classmethod
-    def isLock(cls, lock: Any) -> bool:
-        """Lock status"""
-        return False
-
-    @classmethod
-    def release(cls, lock: Any) -> None:
-        """Release lock"""
+        self.hashes = {}
+        self.expires = {}
+        self.claims.clear()
+        self.queues.clear()
+        self.lists = {}
+        self.members = {}
 
 
+@registerBackend("redis")
 class RedisDB:
     """
     A key-value storage interface
     """
 
     logger = logging.getLogger("attendence.db")
+    packages = ["redis"]
 
     def __init__(self) -> None:
         """Connect to redis instance"""
-        self.redis = Redis.from_url(settings.redis_url, decode_responses=True)
+        from redis import Redis
+
+        # bytes for the encoded (compressed) documents
+        self.redis = Redis.from_url(settings.redis_url, decode_responses=False)
 
     def clear(self) -> None:
         """Remove all data"""
         self.redis.flushall()
 
-    def lock(self, key: str) -> Redlock:
-        """Block the execution depended on the key"""
-        lock = Redlock(key=key, masters={self.redis}, auto_release_time=0.5)
-        lock.acquire()
-        return lock
-
-    @classmethod
-    def isLock(cls, lock: Redlock) -> bool:
-        """Lock status"""
-        return bool(lock.locked())
-
-    @classmethod
-    def release(cls, lock: Redlock) -> None:
-        """Release lock"""
-        lock.release()
-
     def get(self, key: str, default: Any | None = None) -> Any:
         """Get Data by key"""
         raw_value = self.redis.get(key)
         if not raw_value:
             return default
-        value = orjson.loads(raw_value)
-        self.logger.debug(f"Get {key}={value}")
+        value = decode(raw_value)
+        self.logger.debug("Get %s=%s", key, Payload(value))
         return value
 
     def set(self, key: str, value: Any) -> None:
         """Set data by key"""
-        self.redis.set(key, orjson.dumps(value))
-        self.logger.debug(f"Set {key}=\n{pformat(value)}")
+        self.redis.set(key, encode(value))
+        self.logger.debug("Set %s=\n%s", key, Payload(value))
+
+    def setIf(self, key: str, value: Any, version: int) -> bool:
+        """
+        Set data by key if the version of stored data is not changed
+        (WATCH the key and write it in MULTI)
+        """
+        from redis.exceptions import WatchError
+
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                raw_value = pipe.get(key)
+                if versionOf(decode(raw_value) if raw_value else None) != version:
+                    self.logger.debug("Conflict %s version=%s", key, version)
+                    return False
+                pipe.multi()
+                pipe.set(key, encode(value))
+                pipe.execute()
+            except WatchError:
+                self.logger.debug("Conflict %s version=%s", key, version)
+                return False
+        self.logger.debug("Set %s=\n%s", key, Payload(value))
+        return True
+
+    def update(self, key: str, path: list[str], value: Any) -> None:
+        """Set the field (by path) of the data"""
+        updateByVersion(self, key, path, value)
 
     def gets(self, keys: list[str]) -> list[Any]:
         """Get Data by keys"""
         pipe = self.redis.pipeline()
         [pipe.get(key) for key in keys]
-        return [orjson.loads(raw_value) for raw_value in pipe.execute()]
+        return [
+            decode(raw_value) if raw_value else None for raw_value in pipe.execute()
+        ]
 
     def sets(self, key_values: list[tuple[str, Any]]) -> None:
         """Set data by keys and values"""
         pipe = self.redis.pipeline()
-        [pipe.set(key, orjson.dumps(value)) for key, value in key_values]
+        [pipe.set(key, encode(value)) for key, value in key_values]
+        pipe.execute()
+
+    def setsIf(self, items: list[tuple[str, Any, int]]) -> bool:
+        """
+        Set data by keys if none of the versions of stored data are changed
+        (WATCH the keys and write them in one MULTI)
+        """
+        from redis.exceptions import WatchError
+
+        keys = [key for key, _, _ in items]
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(*keys)
+                for (key, _, version), raw_value in zip(items, pipe.mget(keys)):
+                    if versionOf(decode(raw_value) if raw_value else None) != version:
+                        self.logger.debug("Conflict %s version=%s", key, version)
+                        return False
+                pipe.multi()
+                [pipe.set(key, encode(value)) for key, value, _ in items]
+                pipe.execute()
+            except WatchError:
+                self.logger.debug("Conflict %s", keys)
+                return False
+        self.logger.debug("Sets %s", Payload(items, keys_only=True))
+        return True
+
+    def hset(self, key: str, field: str, value: Any) -> None:
+        """Set the field of hash"""
+        self.redis.hset(key, field, orjson.dumps(value))
+        self.logger.debug("Hset %s %s=\n%s", key, field, Payload(value))
+
+    def hsets(self, key: str, values: dict[str, Any], ttl: int | None = None) -> None:
+        """Set the fields of hash (delete the field if None) and the expiry"""
+        pipe = self.redis.pipeline()
+        mapping = {
+            field: orjson.dumps(value)
+            for field, value in values.items()
+            if value is not None
+        }
+        if mapping:
+            pipe.hset(key, mapping=mapping)  # type: ignore
+        deleted = [field for field, value in values.items() if value is None]
+        if deleted:
+            pipe.hdel(key, *deleted)
+        if ttl:
+            pipe.expire(key, ttl)
         pipe.execute()
+        self.logger.debug("Hsets %s=\n%s", key, Payload(values))
+
+    def hget(self, key: str, field: str, default: Any | None = None) -> Any:
+        """Get the field of hash"""
+        raw_value = self.redis.hget(key, field)
+        return orjson.loads(raw_value) if raw_value else default
+
+    def hgetall(self, key: str) -> dict[str, Any]:
+        """Get all the fields and values of hash"""
+        return {
+            field.decode(): orjson.loads(raw_value)
+            for field, raw_value in self.redis.hgetall(key).items()
+        }
+
+    def hkeys(self, key: str) -> list[str]:
+        """Get all the fields of hash"""
+        return [field.decode() for field in self.redis.hkeys(key)]
+
+    def hdel(self, key: str, field: str) -> None:
+        """Delete the field of hash"""
+        self.redis.hdel(key, field)
+        self.logger.debug("Hdel %s %s", key, field)
+
+    def append(self, key: str, value: Any) -> None:
+        """Append the value to the list"""
+        self.redis.rpush(key, orjson.dumps(value))
+        self.logger.debug("Append %s %s", key, Payload(value))
+
+    def lrange(self, key: str, start: int = 0, count: int | None = None) -> list[Any]:
+        """Get count values of the list from start"""
+        if count == 0:
+            return []
+        end = -1 if count is None else start + count - 1
+        return [orjson.loads(value) for value in self.redis.lrange(key, start, end)]
+
+    def llen(self, key: str) -> int:
+        """The length of the list"""
+        return int(self.redis.llen(key))  # type: ignore
+
+    def sadd(self, key: str, members: list[str]) -> None:
+        """Add the members to the set"""
+        if members:
+            self.redis.sadd(key, *members)
+        self.logger.debug("Sadd %s %s", key, Payload(members))
+
+    def srem(self, key: str, members: list[str]) -> None:
+        """Remove the members from the set"""
+        if members:
+            self.redis.srem(key, *members)
+        self.logger.debug("Srem %s %s", key, Payload(members))
+
+    def smembers(self, key: str) -> list[str]:
+        """Get all the members of the set"""
+        return [member.decode() for member in self.redis.smembers(key)]  # type: ignore
+
+    def scard(self, key: str) -> int:
+        """The number of members in the set"""
+        return int(self.redis.scard(key))  # type: ignore
+
+    def push(self, key: str, value: Any) -> None:
+        """Append the value to the queue (list)"""
+        self.redis.rpush(key, orjson.dumps(value))
+
+    def pop(self, key: str, timeout: float = 1, processing: str | None = None) -> Any:
+        """
+        Pop the first value of the queue (wait until timeout if empty)
+        and keep it in the processing list until ack (if given, by BLMOVE)
+        """
+        if processing:
+            if not timeout:  # 0 means forever in BLMOVE
+                raw_value = self.redis.lmove(key, processing, "LEFT", "RIGHT")
+            else:
+                raw_value = self.redis.blmove(key, processing, timeout, "LEFT", "RIGHT")
+        elif not timeout:  # 0 means forever in BLPOP
+            raw_value = self.redis.lpop(key)
+        else:
+            item = self.redis.blpop([key], timeout=timeout)
+            raw_value = item[1] if item else None
+        return orjson.loads(raw_value) if raw_value else None  # type: ignore
+
+    def ack(self, processing: str, value: Any) -> None:
+        """Remove the handled value from the processing list"""
+        self.redis.lrem(processing, 1, orjson.dumps(value))
+
+    def requeue(self, processing: str, key: str) -> int:
+        """Move the values in processing list back to the front of the queue"""
+        count = 0
+        while self.redis.lmove(processing, key, "RIGHT", "LEFT"):
+            count += 1
+        return count
+
+    def claim(self, key: str, ttl: int) -> bool:
+        """Mark the key for ttl seconds, False if it is marked already"""
+        return bool(self.redis.set(key, 1, nx=True, ex=ttl))
 
     def delete(self, key: str) -> None:
         """Delete key"""
         self.redis.delete(key)
-        self.logger.debug(f"Delete {key}")
+        self.logger.debug("Delete %s", key)
 
-    def create(self, prefix: str) -> str:
-        """Find a random and unused key"""
+    def createWith(self, prefix: str, value: Any) -> str:
+        """
+        Save the value at a random and unused key (saved in value["id"])
+        by one SET NX (retry only if the key is used)
+        """
         while True:
             key = prefix + str(uuid.uuid4())
-            if not self.redis.exists(key):
+            value["id"] = key
+            if self.redis.set(key, encode(value), nx=True):
                 break
+        self.logger.debug("Create %s=\n%s", key, Payload(value))
         return key
 
 
+@registerBackend("dynamodb")
 class DynamoDB:
     """
     A KV storage of AWS
     """
 
     logger = logging.getLogger("attendence.db")
+    packages = ["boto3"]
+    batch_get_size = 100  # BatchGetItem limit
+    batch_write_size = 25  # BatchWriteItem limit
+    transact_size = 100  # TransactWriteItems limit
+    batch_retry = 8
+    batch_backoff = 0.05  # seconds, doubled at each retry
+    verified_tables: set[str] = set()
+    hash_prefix = "h:"  # The fields of hash are the attributes of the item
 
     def __init__(self) -> None:
-        """Connect to redis instance"""
+        """
+        Connect to DynamoDB.
+
+        No control-plane API is called here unless settings.dynamodb_provision
+        asks for it. Run `python db.py provision` once when deploying.
+        """
+        import boto3
+
         self.dynamo_client = boto3.client("dynamodb")
         self.dynamo_resource = boto3.resource("dynamodb")
-        self.createTable()
-        self.createLockTable()
+        self.db = self.dynamo_resource.Table(settings.dynamodb_table)
+        if settings.dynamodb_provision == "create":
+            self.provision()
+        elif settings.dynamodb_provision == "verify":
+            self.verify()
+        elif settings.dynamodb_provision != "skip":
+            raise ValueError(f"Provision mode {settings.dynamodb_provision} not found")
 
-    def createLockTable(self) -> None:
-        """
-        Create Lock table
-        However, there is not official implemented package.
-        I use outdated https://github.com/mohankishore/python_dynamodb_lock.
-        Maybe I'll change it
-        """
-        self.lock_client = DynamoDBLockClient(
-            self.dynamo_resource,
-            table_name=settings.dynamodb_table + "-lock",
-            expiry_period=timedelta(seconds=30),
-        )
+    def verify(self) -> None:
+        """Check the table exists (once per process) or create it"""
+        from botocore.exceptions import ClientError
+
+        if settings.dynamodb_table in DynamoDB.verified_tables:
+            return
         try:
-            self.logger.info(f"Creating {self.lock_client._table_name}")
-            db_lock = self.dynamo_resource.create_table(
-                TableName=self.lock_client._table_name,
-                KeySchema=[
-                    {
-                        "AttributeName": self.lock_client._partition_key_name,
-                        "KeyType": "HASH",
-                    },
-                    {
-                        "AttributeName": self.lock_client._sort_key_name,
-                        "KeyType": "RANGE",
-                    },
-                ],
-                AttributeDefinitions=[
-                    {
-                        "AttributeName": self.lock_client._partition_key_name,
-                        "AttributeType": "S",
-                    },
-                    {
-                        "AttributeName": self.lock_client._sort_key_name,
-                        "AttributeType": "S",
-                    },
-                ],
-                **settings.dynamodb_other,
-            )
-            db_lock.wait_until_exists()
-            self.dynamo_client.update_time_to_live(
-                TableName=self.lock_client._table_name,
-                TimeToLiveSpecification={
-                    "Enabled": True,
-                    "AttributeName": self.lock_client._ttl_attribute_name,
-                },
-            )
-            db_lock.wait_until_exists()
+            self.dynamo_client.describe_table(TableName=self.db.name)
+        except ClientError:
+            self.logger.info(f"Table {self.db.name} not found")
+            self.provision()
+        DynamoDB.verified_tables.add(settings.dynamodb_table)
 
-        except boto3.exceptions.botocore.exceptions.ClientError:
-            self.logger.info(f"{self.lock_client._table_name} has created")
-            pass
+    def provision(self) -> None:
+        """Create the table if not exist (and enable TTL)"""
+        self.createTable()
+        DynamoDB.verified_tables.add(settings.dynamodb_table)
 
     def createTable(self) -> None:
         """Create or use the table"""
+        from botocore.exceptions import ClientError
+
         try:
             self.db = self.dynamo_resource.create_table(
                 TableName=settings.dynamodb_table,
@@ -226,89 +609,584 @@ class DynamoDB:
             )
             self.db.wait_until_exists()
             self.logger.info(f"Create {self.db}")
-        except boto3.exceptions.botocore.exceptions.ClientError:
+        except ClientError:
             self.db = self.dynamo_resource.Table(settings.dynamodb_table)
             self.logger.info(f"Use existed {self.db}")
+        self.enableTTL()
+
+    def enableTTL(self) -> None:
+        """Let DynamoDB remove the expired items (by ttl attribute) if not yet"""
+        status = self.dynamo_client.describe_time_to_live(
+            TableName=settings.dynamodb_table
+        )["TimeToLiveDescription"]
+        if status.get("TimeToLiveStatus") in ("ENABLED", "ENABLING"):
+            return
+        self.dynamo_client.update_time_to_live(
+            TableName=settings.dynamodb_table,
+            TimeToLiveSpecification={"Enabled": True, "AttributeName": "ttl"},
+        )
+        self.logger.info(f"Enable TTL of {self.db}")
 
     def clear(self) -> None:
         """Remove all data"""
-        self.logger.info(f"Delete {self.db}")
-        self.db.delete()
-        db_lock = self.dynamo_resource.Table(self.lock_client._table_name)
-        self.logger.info(f"Delete {db_lock}")
-        db_lock.delete()
-        self.db.wait_until_not_exists()
-        db_lock.wait_until_not_exists()
-        self.createTable()
-        self.createLockTable()
-
-    @classmethod
-    def isLock(cls, lock: DynamoDBLock) -> bool:
-        """Lock status"""
-        return lock.status == "LOCKED"  # type: ignore
-
-    @classmethod
-    def release(cls, lock: DynamoDBLock) -> None:
-        """Release lock"""
-        lock.release()
+        from botocore.exceptions import ClientError
 
-    def lock(self, key: str) -> DynamoDBLock:
-        """Block the execution depended on the key"""
-        return self.lock_client.acquire_lock(key)
+        try:
+            self.logger.info(f"Delete {self.db}")
+            self.db.delete()
+            self.db.wait_until_not_exists()
+        except ClientError:
+            self.logger.info(f"{self.db} not found")
+        self.provision()
 
     def get(self, key: str, default: Any | None = None) -> Any:
         """Get Data by key"""
         raw_value = self.db.get_item(Key={"id": key}).get("Item")
         if not raw_value:
             return default
-        value = orjson.loads(raw_value["data"].value)
-        self.logger.debug(f"Get {key}={value}")
+        value = self.fromItem(raw_value)
+        self.logger.debug("Get %s=%s", key, Payload(value))
         return value
-        # directly save dict into db
-        # return raw_value
 
     def set(self, key: str, value: Any) -> None:
         """Set data by key"""
-        # why dynamodb not support time
-        # directly save dict into db
-        # value['id'] = key
-        # self.db.put_item(Item=value)
-        self.db.put_item(Item={"id": key, "data": orjson.dumps(value)})
-        self.logger.debug(f"Set {key}=\n{pformat(value)}")
+        self.db.put_item(Item=self.toItem(key, value))
+        self.logger.debug("Set %s=\n%s", key, Payload(value))
+
+    def setIf(self, key: str, value: Any, version: int) -> bool:
+        """Set data by key if the version of stored data is not changed"""
+        from botocore.exceptions import ClientError
+
+        condition = "#version = :version"
+        if not version:
+            condition = "attribute_not_exists(#version) OR " + condition
+        try:
+            self.db.put_item(
+                Item=self.toItem(key, value),
+                ConditionExpression=condition,
+                ExpressionAttributeNames={"#version": "version"},
+                ExpressionAttributeValues={":version": version},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            self.logger.debug("Conflict %s version=%s", key, version)
+            return False
+        self.logger.debug("Set %s=\n%s", key, Payload(value))
+        return True
+
+    def update(self, key: str, path: list[str], value: Any) -> None:
+        """
+        Set the field (by path) of the data.
+
+        In native format, only the field is written by UpdateExpression
+        (e.g. SET data.users.#uid = :value) if its parent map exists,
+        otherwise (blob items, missing data or parents),
+        the whole data is rewritten.
+        """
+        from botocore.exceptions import ClientError
+
+        if settings.dynamodb_format != "native":
+            updateByVersion(self, key, path, value)
+            return
+        names = {f"#p{i}": name for i, name in enumerate(path)}
+        field_path = ["#data", *names]
+        parent = ".".join(field_path[:-1])
+        try:
+            self.db.update_item(
+                Key={"id": key},
+                UpdateExpression=f"SET {'.'.join(field_path)} = :value "
+                "ADD #version :one",
+                ConditionExpression=f"attribute_type({parent}, :map)",
+                ExpressionAttributeNames={
+                    "#data": "data",
+                    "#version": "version",
+                    **names,
+                },
+                ExpressionAttributeValues={
+                    ":value": self.toNative(value),
+                    ":one": 1,
+                    ":map": "M",
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            updateByVersion(self, key, path, value)
+            return
+        self.logger.debug("Update %s %s=\n%s", key, path, Payload(value))
+
+    @classmethod
+    def isExpired(cls, item: dict[str, Any]) -> bool:
+        """TTL deletion of DynamoDB is delayed, check it when reading"""
+        return bool(item.get("ttl")) and item["ttl"] < time.time()
+
+    def deleteExpired(self, key: str) -> None:
+        """
+        Delete the expired item now, otherwise the next update (SET)
+        of the item brings its old fields back
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            self.db.delete_item(
+                Key={"id": key},
+                ConditionExpression="#ttl <= :now",  # not renewed meanwhile
+                ExpressionAttributeNames={"#ttl": "ttl"},
+                ExpressionAttributeValues={":now": int(time.time())},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        self.logger.debug("Delete expired %s", key)
+
+    @classmethod
+    def toItem(cls, key: str, value: Any) -> dict[str, Any]:
+        """The item saved in table (version is a separated attribute for condition)"""
+        return {"id": key, "data": cls.toData(value), "version": versionOf(value)}
+
+    @classmethod
+    def fromItem(cls, item: dict[str, Any]) -> Any:
+        """The item -> data"""
+        value = cls.fromData(item["data"])
+        if isinstance(value, dict) and "version" in item:
+            value["_version"] = int(item["version"])
+        return value
+
+    @classmethod
+    def toData(cls, value: Any) -> Any:
+        """Data -> attribute value (in the format of settings.dynamodb_format)"""
+        if settings.dynamodb_format == "native":
+            return cls.toNative(value)
+        return encode(value)
+
+    @classmethod
+    def fromData(cls, data: Any) -> Any:
+        """Attribute value (either of the formats) -> data"""
+        if hasattr(data, "value"):  # Binary
+            return decode(data.value)
+        return cls.fromNative(data)
+
+    @classmethod
+    def toNative(cls, value: Any) -> Any:
+        """Json-like data -> DynamoDB types (Decimal instead of float)"""
+        return json.loads(orjson.dumps(value), parse_float=Decimal)
+
+    @classmethod
+    def fromNative(cls, value: Any) -> Any:
+        """DynamoDB types -> Json-like data"""
+        if isinstance(value, Decimal):
+            return int(value) if value == value.to_integral_value() else float(value)
+        if isinstance(value, dict):
+            return {k: cls.fromNative(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [cls.fromNative(v) for v in value]
+        return value
 
     def gets(self, keys: list[str]) -> list[Any]:
-        """Get Data by keys"""
-        raise NotImplementedError
+        """Get Data by keys (BatchGetItem, 100 keys per request)"""
+        values: dict[str, Any] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), self.batch_get_size):
+            request = {
+                self.db.name: {
+                    "Keys": [
+                        {"id": key} for key in unique_keys[i : i + self.batch_get_size]
+                    ]
+                }
+            }
+            for response in self.retryBatch(
+                self.dynamo_resource.batch_get_item, request, "UnprocessedKeys"
+            ):
+                for item in response["Responses"].get(self.db.name, []):
+                    values[item["id"]] = self.fromItem(item)
+        self.logger.debug("Gets %s", keys)
+        return [values.get(key) for key in keys]
 
     def sets(self, key_values: list[tuple[str, Any]]) -> None:
-        """Set data by keys and values"""
-        raise NotImplementedError
-        # with self.db.batch_writer() as writer:
-        #     for key, value in key_values:
-        #         value['id'] = key
-        #         writer.put_item(Item=value)
+        """Set data by keys and values (BatchWriteItem, 25 items per request)"""
+        # the same key cannot appear twice in one batch
+        items = list(dict(key_values).items())
+        for i in range(0, len(items), self.batch_write_size):
+            request = {
+                self.db.name: [
+                    {"PutRequest": {"Item": self.toItem(key, value)}}
+                    for key, value in items[i : i + self.batch_write_size]
+                ]
+            }
+            for _ in self.retryBatch(
+                self.dynamo_resource.batch_write_item, request, "UnprocessedItems"
+            ):
+                pass
+        self.logger.debug("Sets %s", Payload(items, keys_only=True))
+
+    def setsIf(self, items: list[tuple[str, Any, int]]) -> bool:
+        """
+        Set data by keys if none of the versions of stored data are changed
+        (TransactWriteItems, all or nothing for every 100 items)
+        """
+        from botocore.exceptions import ClientError
+
+        for i in range(0, len(items), self.transact_size):
+            request = []
+            for key, value, version in items[i : i + self.transact_size]:
+                condition = "#version = :version"
+                if not version:
+                    condition = "attribute_not_exists(#version) OR " + condition
+                request.append(
+                    {
+                        "Put": {
+                            "TableName": self.db.name,
+                            "Item": self.toItem(key, value),
+                            "ConditionExpression": condition,
+                            "ExpressionAttributeNames": {"#version": "version"},
+                            "ExpressionAttributeValues": {":version": version},
+                        }
+                    }
+                )
+            try:
+                self.dynamo_resource.meta.client.transact_write_items(
+                    TransactItems=request
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "TransactionCanceledException":
+                    raise
+                self.logger.debug("Conflict %s", [key for key, _, _ in items])
+                return False
+        self.logger.debug("Sets %s", Payload(items, keys_only=True))
+        return True
+
+    def retryBatch(
+        self, func: Any, request: dict[str, Any], unprocessed: str
+    ) -> Iterator[Any]:
+        """
+        Call the batch API until there are no unprocessed keys/items.
+        The unprocessed part is resent with exponential backoff.
+        """
+        for retry in range(self.batch_retry):
+            response = func(RequestItems=request)
+            yield response
+            request = response.get(unprocessed)
+            if not request:
+                return
+            if retry == self.batch_retry - 1:  # no more retry, don't wait
+                break
+            self.logger.info(f"Retry {unprocessed} of {list(request)}")
+            time.sleep(min(self.batch_backoff * 2**retry, 1.0))
+        raise RuntimeError(f"{unprocessed} remain after {self.batch_retry} retries")
+
+    def hset(self, key: str, field: str, value: Any) -> None:
+        """Set the field of hash (an attribute of the item)"""
+        self.db.update_item(
+            Key={"id": key},
+            UpdateExpression="SET #field = :value",
+            ExpressionAttributeNames={"#field": self.hash_prefix + field},
+            ExpressionAttributeValues={":value": self.toData(value)},
+        )
+        self.logger.debug("Hset %s %s=\n%s", key, field, Payload(value))
+
+    def hsets(self, key: str, values: dict[str, Any], ttl: int | None = None) -> None:
+        """
+        Set the fields of hash (delete the field if None) and the expiry
+        by one UpdateItem (DynamoDB removes the item after ttl attribute)
+        """
+        names, updates, removes, attr_values = {}, [], [], {}
+        for i, (field, value) in enumerate(values.items()):
+            names[f"#f{i}"] = self.hash_prefix + field
+            if value is None:
+                removes.append(f"#f{i}")
+            else:
+                updates.append(f"#f{i} = :v{i}")
+                attr_values[f":v{i}"] = self.toData(value)
+        if ttl:
+            names["#ttl"] = "ttl"
+            updates.append("#ttl = :ttl")
+            attr_values[":ttl"] = int(time.time()) + ttl
+        expression = ""
+        if updates:
+            expression += "SET " + ", ".join(updates) + " "
+        if removes:
+            expression += "REMOVE " + ", ".join(removes)
+        if not expression:
+            return
+        self.db.update_item(
+            Key={"id": key},
+            UpdateExpression=expression,
+            ExpressionAttributeNames=names,
+            **({"ExpressionAttributeValues": attr_values} if attr_values else {}),
+        )
+        self.logger.debug("Hsets %s=\n%s", key, Payload(values))
+
+    def hget(self, key: str, field: str, default: Any | None = None) -> Any:
+        """Get the field of hash"""
+        item = self.db.get_item(
+            Key={"id": key},
+            ProjectionExpression="#field, #ttl",
+            ExpressionAttributeNames={
+                "#field": self.hash_prefix + field,
+                "#ttl": "ttl",
+            },
+        ).get("Item", {})
+        if self.isExpired(item):
+            self.deleteExpired(key)
+            return default
+        if self.hash_prefix + field not in item:
+            return default
+        return self.fromData(item[self.hash_prefix + field])
+
+    def hgetall(self, key: str) -> dict[str, Any]:
+        """Get all the fields and values of hash"""
+        item = self.db.get_item(Key={"id": key}).get("Item", {})
+        if self.isExpired(item):
+            self.deleteExpired(key)
+            return {}
+        return {
+            name[len(self.hash_prefix) :]: self.fromData(value)
+            for name, value in item.items()
+            if name.startswith(self.hash_prefix)
+        }
+
+    def hkeys(self, key: str) -> list[str]:
+        """Get all the fields of hash"""
+        return list(self.hgetall(key))
+
+    def hdel(self, key: str, field: str) -> None:
+        """Delete the field of hash"""
+        self.db.update_item(
+            Key={"id": key},
+            UpdateExpression="REMOVE #field",
+            ExpressionAttributeNames={"#field": self.hash_prefix + field},
+        )
+        self.logger.debug("Hdel %s %s", key, field)
+
+    def append(self, key: str, value: Any) -> None:
+        """
+        Append the value to the list.
+
+        Every value is an item ([key]:[index]) so the item of list doesn't grow,
+        the index is from the counter ([key]) increased atomically.
+        """
+        length = self.db.update_item(
+            Key={"id": key},
+            UpdateExpression="ADD #length :one",
+            ExpressionAttributeNames={"#length": "length"},
+            ExpressionAttributeValues={":one": 1},
+            ReturnValues="UPDATED_NEW",
+        )["Attributes"]["length"]
+        self.db.put_item(Item=self.toItem(f"{key}:{int(length) - 1}", value))
+        self.logger.debug("Append %s %s", key, Payload(value))
+
+    def lrange(self, key: str, start: int = 0, count: int | None = None) -> list[Any]:
+        """Get count values of the list from start (only the items in the page)"""
+        end = self.llen(key) if count is None else start + count
+        values = self.gets([f"{key}:{i}" for i in range(start, end)])
+        return [value for value in values if value is not None]
+
+    def llen(self, key: str) -> int:
+        """The length of the list"""
+        item = self.db.get_item(
+            Key={"id": key},
+            ProjectionExpression="#length",
+            ExpressionAttributeNames={"#length": "length"},
+        ).get("Item", {})
+        return int(item.get("length", 0))
+
+    def sadd(self, key: str, members: list[str]) -> None:
+        """
+        Add the members to the set (a string set attribute of the item)
+        and count them (count attribute), so scard doesn't read the set.
+
+        A new set is written by one UpdateItem, otherwise each member is added
+        only if not in the set (the count is increased with it).
+        """
+        from botocore.exceptions import ClientError
+
+        members = list(dict.fromkeys(members))
+        if not members:  # empty set is not allowed
+            return
+        try:
+            self.db.update_item(
+                Key={"id": key},
+                UpdateExpression="SET #members = :members, #count = :count",
+                ConditionExpression="attribute_not_exists(#members)",
+                ExpressionAttributeNames={"#members": "members", "#count": "count"},
+                ExpressionAttributeValues={
+                    ":members": set(members),
+                    ":count": len(members),
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            for member in members:
+                self.updateMember(key, member, add=True)
+        self.logger.debug("Sadd %s %s", key, Payload(members))
+
+    def srem(self, key: str, members: list[str]) -> None:
+        """Remove the members from the set (and the count)"""
+        for member in dict.fromkeys(members):
+            self.updateMember(key, member, add=False)
+        self.logger.debug("Srem %s %s", key, Payload(members))
+
+    def updateMember(self, key: str, member: str, add: bool) -> None:
+        """Add/remove the member and its count if it is not/is in the set"""
+        from botocore.exceptions import ClientError
+
+        try:
+            self.db.update_item(
+                Key={"id": key},
+                UpdateExpression=(
+                    "ADD #members :member, #count :one"
+                    if add
+                    else "DELETE #members :member ADD #count :one"
+                ),
+                ConditionExpression=(
+                    "NOT contains(#members, :name)"
+                    if add
+                    else "contains(#members, :name)"
+                ),
+                ExpressionAttributeNames={"#members": "members", "#count": "count"},
+                ExpressionAttributeValues={
+                    ":member": {member},
+                    ":name": member,
+                    ":one": 1 if add else -1,
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    def smembers(self, key: str) -> list[str]:
+        """Get all the members of the set"""
+        item = self.db.get_item(
+            Key={"id": key},
+            ProjectionExpression="#members",
+            ExpressionAttributeNames={"#members": "members"},
+        ).get("Item", {})
+        return list(item.get("members", []))
+
+    def scard(self, key: str) -> int:
+        """The number of members in the set (only the count is read)"""
+        item = self.db.get_item(
+            Key={"id": key},
+            ProjectionExpression="#count",
+            ExpressionAttributeNames={"#count": "count"},
+        ).get("Item", {})
+        return int(item.get("count", 0))
+
+    def claim(self, key: str, ttl: int) -> bool:
+        """Mark the key for ttl seconds, False if it is marked already"""
+        from botocore.exceptions import ClientError
+
+        now = int(time.time())
+        try:
+            self.db.put_item(
+                Item={"id": key, "ttl": now + ttl},
+                ConditionExpression="attribute_not_exists(id) OR #ttl < :now",
+                ExpressionAttributeNames={"#ttl": "ttl"},
+                ExpressionAttributeValues={":now": now},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        return True
 
     def delete(self, key: str) -> None:
         """Delete key"""
         self.db.delete_item(Key={"id": key})
-        self.logger.debug(f"Delete {key}")
+        self.logger.debug("Delete %s", key)
+
+    def createWith(self, prefix: str, value: Any) -> str:
+        """
+        Save the value at a random and unused key (saved in value["id"])
+        by one conditional PutItem (retry only if the key is used)
+        """
+        from botocore.exceptions import ClientError
 
-    def create(self, prefix: str) -> str:
-        """Find a random and unused key"""
         while True:
             key = prefix + str(uuid.uuid4())
-            if not self.get(key):
+            value["id"] = key
+            try:
+                self.db.put_item(
+                    Item=self.toItem(key, value),
+                    ConditionExpression="attribute_not_exists(id)",
+                )
                 break
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+        self.logger.debug("Create %s=\n%s", key, Payload(value))
         return key
 
 
-if settings.db == "object":
-    db_instance = KVData()
-elif settings.db == "redis":
-    db_instance = RedisDB()
-elif settings.db == "dynamodb":
-    db_instance = DynamoDB()
-else:
-    raise ValueError(f"DB type {settings.db} not found")
-if settings.mode == "test":
-    db_instance.clear()
+class LazyDB:
+    """
+    The storage backend selected by settings.db.
+
+    The backend (and the packages it requires) is imported and connected
+    when it is first used instead of at import time.
+    """
+
+    # the interface of the backends recorded in metrics
+    operations = {
+        *("get", "gets", "set", "sets", "setIf", "setsIf", "update", "createWith"),
+        *("hset", "hsets", "hget", "hgetall", "hkeys", "hdel", "push", "pop"),
+        *("append", "lrange", "llen", "claim", "delete", "ack", "requeue"),
+        *("sadd", "srem", "smembers", "scard"),
+    }
+
+    def __init__(self, name: str):
+        if name not in backends:
+            raise ValueError(f"DB type {name} not found")
+        self.name = name
+        self.instance: Any = None
+        self.lock = threading.Lock()
+
+    def load(self) -> Any:
+        """Create the backend instance at the first call (once for all threads)"""
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    instance = backends[self.name]()
+                    if settings.mode == "test":
+                        instance.clear()
+                    self.instance = instance  # shown only when it is ready
+        return self.instance
+
+    def __getattr__(self, name: str) -> Any:
+        if name not in self.operations:
+            return getattr(self.load(), name)
+        self.load()
+        timed = self.timed(name)
+        setattr(self, name, timed)  # not to wrap again
+        return timed
+
+    def timed(self, name: str) -> Callable[..., Any]:
+        """The DB operation recorded in metrics"""
+        from metrics import metrics
+
+        def wrap(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return getattr(self.instance, name)(*args, **kwargs)
+            finally:
+                key = args[0] if args and isinstance(args[0], str) else ""
+                metrics.observeDB(self.name, name, key, time.perf_counter() - start)
+
+        return wrap
+
+
+db_instance = LazyDB(settings.db)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["provision"]:
+        # Create the tables (DynamoDB) before deploying
+        db = backends[settings.db]()
+        if hasattr(db, "provision"):
+            db.provision()
+    else:
+        print("Usage: python db.py provision")
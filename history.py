@@ -8,17 +8,24 @@ class History(Base):
     """
     The history of user response to report
 
+    The responses are appended to a list (no read-modify-write of
+    all the responses when user responses).
+    The history saved in the document before is still read.
+
     Structure:
     ```
-    [history-reportid-user_id]:
+    [historylist-reportid-user_id]: [json-info]
+    [history-reportid-user_id]: (before)
         id: str
         report: ID
         user: ID
         history: [json-info]
+    ```
     """
 
     def __init__(self, report_id: str, user_id: str):
         super().__init__(f"history-{report_id}-{user_id}")
+        self.list_id = f"historylist-{report_id}-{user_id}"
         self._default = {
             "id": self.id,
             "report": report_id,
@@ -28,4 +35,19 @@ class History(Base):
 
     def addResponse(self, data: Any) -> None:
         """User response to the report and save here"""
-        self["history"].append(data)
+        self.db.append(self.list_id, data)
+
+    def countResponse(self) -> int:
+        """The number of the responses"""
+        return len(self["history"]) + self.db.llen(self.list_id)
+
+    def listResponse(self, start: int = 0, count: int | None = None) -> list[Any]:
+        """The responses from start (the oldest first)"""
+        history = self["history"]
+        responses = history[start : None if count is None else start + count]
+        if count is not None:
+            count -= len(responses)
+        if count != 0:
+            start = max(start - len(history), 0)
+            responses.extend(self.db.lrange(self.list_id, start, count))
+        return responses
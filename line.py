@@ -1,9 +1,13 @@
+import sys
 import logging
+from typing import Any
+from concurrent.futures import Future, wait
 
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from flask import Flask, Response, request, abort
+from linebot import LineBotApi, WebhookParser
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import (
+    Event,
     MessageEvent,
     TextMessage,
     TextSendMessage,
@@ -14,13 +18,33 @@ from linebot.models import (
 
 
 from command import app as attendence_app
-from response import RespText, RespChoice
+from response import RespChoice
+from worker import EventWorker, Dispatcher
+from metrics import metrics
+from db import db_instance
 import settings
 
 app = Flask(__name__)
 line_bot_api = LineBotApi(settings.line_token)
-handler = WebhookHandler(settings.line_webhook)
+parser = WebhookParser(settings.line_webhook)
 logger = logging.getLogger("attendence.line")
+# events of different users are handled in parallel
+dispatcher = Dispatcher(settings.webhook_workers)
+
+
+def handleRequest(item: dict[str, str]) -> list[Future[None]]:
+    """Handle the queued webhook request (without waiting the events)"""
+    events = parser.parse(item["body"], item["signature"])
+    return dispatcher.dispatch(events, key=eventUser, handle=handleEvent)
+
+
+# One consumer keeps the order of requests, the events run in dispatcher
+# (the unfinished requests of the process of the same name are requeued at start)
+event_worker = EventWorker(
+    handleRequest, workers=1, name="worker" if sys.argv[1:] == ["worker"] else "web"
+)
+if settings.webhook_mode == "queue":
+    EventWorker.checkBackend()  # fail at startup instead of at every webhook
 
 
 @app.route("/callback", methods=["POST"])
@@ -33,7 +57,12 @@ async def callback():
     logger.debug("Request body: " + body)
     # handle webhook body
     try:
-        handler.handle(body, signature)
+        events = parser.parse(body, signature)
+        if settings.webhook_mode == "queue":
+            # ack first, the events are handled by event_worker
+            event_worker.put({"body": body, "signature": signature})
+        else:
+            wait(dispatcher.dispatch(events, key=eventUser, handle=handleEvent))
     except InvalidSignatureError:
         logger.debug(
             "Invalid signature. Please check your channel access token/channel secret."
@@ -42,7 +71,35 @@ async def callback():
     return "OK"
 
 
-@handler.add(MessageEvent, message=TextMessage)
+@app.route("/metrics", methods=["GET"])
+def getMetrics():
+    """Metrics of the commands and DB operations (Prometheus format)"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def eventUser(event: Event) -> str:
+    """The events of the same user must be handled in order"""
+    return str(getattr(event.source, "user_id", ""))
+
+
+def handleEvent(event: Event) -> None:
+    """Handle one event (only text message now)"""
+    if not isinstance(event, MessageEvent) or not isinstance(
+        event.message, TextMessage
+    ):
+        return
+    # LINE redelivers the event if the webhook is timeout
+    key = "event-" + str(event.webhook_event_id)
+    if event.webhook_event_id and not db_instance.claim(key, settings.event_ttl):
+        logger.info(f"Skip handled event {event.webhook_event_id}")
+        return
+    try:
+        lineHandle(event)
+    except Exception:
+        db_instance.delete(key)  # can be handled again
+        raise
+
+
 def lineHandle(event: MessageEvent):
     """LINE message -> My Handling"""
     logger.debug(str(event))
@@ -53,26 +110,25 @@ def lineHandle(event: MessageEvent):
 
     resp = attendence_app.handle(line_id, text, event, line_bot_api=line_bot_api)
 
+    messages = [TextSendMessage(text=text) for text in resp.texts]
     if isinstance(resp, RespChoice):
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(
-                text=resp.text,
-                quick_reply=QuickReply(
-                    items=[
-                        QuickReplyButton(
-                            action=MessageAction(label=choice, text=choice)
-                        )
-                        for choice in resp.choices
-                    ]
-                ),
-            ),
-        )
-    elif isinstance(resp, RespText):
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=resp.text),
+        # the choices are shown under the last message
+        messages[-1].quick_reply = QuickReply(
+            items=[
+                QuickReplyButton(action=MessageAction(label=choice, text=choice))
+                for choice in resp.choices
+            ]
         )
+    reply(event, messages)
+
+
+def reply(event: MessageEvent, messages: Any) -> None:
+    """Reply to the event, or push if the reply token is expired (e.g. queued)"""
+    try:
+        line_bot_api.reply_message(event.reply_token, messages)
+    except LineBotApiError as e:
+        logger.info(f"Reply failed ({e.status_code}), push instead")
+        line_bot_api.push_message(event.source.user_id, messages)
 
 
 if __name__ == "__main__":
@@ -85,4 +141,12 @@ if __name__ == "__main__":
     # app.handle(admin_user, "電話")
     # app.handle(admin_user, "結束")
     # app = app_web
-    app.run(host="0.0.0.0", port=settings.port, debug=settings.mode == "test")
+    if sys.argv[1:] == ["worker"]:
+        # Only run the workers (webhook_mode = "queue" in the other process)
+        event_worker.start()
+        for thread in event_worker.threads:
+            thread.join()
+    else:
+        if settings.webhook_mode == "queue":
+            event_worker.start()
+        app.run(host="0.0.0.0", port=settings.port, debug=settings.mode == "test")
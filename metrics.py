@@ -0,0 +1,184 @@
+import sys
+import json
+import time
+import threading
+from typing import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+import settings
+
+Labels = tuple[tuple[str, str], ...]
+
+
+@dataclass
+class Request:
+    """The command and the DB operations of one handled message"""
+
+    command: str = ""
+    operations: list[tuple[str, str, str, float]] = field(default_factory=list)
+
+
+current_request: ContextVar[Request | None] = ContextVar("request", default=None)
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the commands and DB operations.
+
+    The DB operations of a message are labeled by the command of the message
+    (known after the talk is read), so they are recorded at the end of it.
+
+    Use case:
+    ```
+    with metrics.request():
+        metrics.setCommand("create team")
+        metrics.observeDB("redis", "get", "team-xxx", 0.001)
+    print(metrics.render())  # Prometheus text format
+    ```
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters: dict[str, dict[Labels, float]] = {}
+        # [count of each bucket..., sum, count]
+        self.histograms: dict[str, dict[Labels, list[float]]] = {}
+
+    def clear(self) -> None:
+        """Remove all the values"""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name: str, labels: Labels, value: float = 1) -> None:
+        """Increase the counter"""
+        counter = self.counters.setdefault(name, {})
+        counter[labels] = counter.get(labels, 0) + value
+
+    def observe(self, name: str, labels: Labels, seconds: float) -> None:
+        """Add the time to the histogram"""
+        histogram = self.histograms.setdefault(name, {})
+        values = histogram.get(labels)
+        if values is None:
+            values = histogram[labels] = [0.0] * (len(self.buckets) + 2)
+        # the time over the last bucket is only in the count (+Inf)
+        for i, bucket in enumerate(self.buckets):
+            if seconds <= bucket:
+                values[i] += 1
+                break
+        values[-2] += seconds
+        values[-1] += 1
+
+    @contextmanager
+    def request(self) -> Iterator[Request]:
+        """Collect the metrics of the message handled inside"""
+        request = Request()
+        token = current_request.set(request)
+        start = time.perf_counter()
+        try:
+            yield request
+        finally:
+            current_request.reset(token)
+            self.record(request, time.perf_counter() - start)
+
+    def setCommand(self, command: str) -> None:
+        """Label the current message by the command"""
+        request = current_request.get()
+        if request is not None:
+            request.command = command
+
+    def observeDB(self, backend: str, operation: str, key: str, seconds: float) -> None:
+        """Record the DB operation (of the current message)"""
+        kind = key.split("-", 1)[0]  # the key prefix, e.g. team, talkstate
+        request = current_request.get()
+        if request is not None:
+            request.operations.append((backend, operation, kind, seconds))
+            return
+        with self.lock:
+            self.recordDB("", backend, operation, kind, seconds)
+
+    def record(self, request: Request, seconds: float) -> None:
+        """Record the message and its DB operations"""
+        command = (("command", request.command),)
+        with self.lock:
+            self.inc("attendence_commands_total", command)
+            self.observe("attendence_command_seconds", command, seconds)
+            for operation in request.operations:
+                self.recordDB(request.command, *operation)
+        if settings.metrics_emf:
+            self.emf(request, seconds)
+
+    def recordDB(
+        self, command: str, backend: str, operation: str, kind: str, seconds: float
+    ) -> None:
+        """Record one DB operation (the lock is held)"""
+        labels = (("command", command), ("operation", operation), ("backend", backend))
+        self.inc("attendence_db_operations_total", labels + (("key", kind),))
+        self.observe("attendence_db_seconds", labels, seconds)
+
+    def emf(self, request: Request, seconds: float) -> None:
+        """Print the metrics of the message in CloudWatch embedded metric format"""
+        data = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": "attendence",
+                        "Dimensions": [["command"]],
+                        "Metrics": [
+                            {"Name": "Latency", "Unit": "Milliseconds"},
+                            {"Name": "DBOperations", "Unit": "Count"},
+                            {"Name": "DBLatency", "Unit": "Milliseconds"},
+                        ],
+                    }
+                ],
+            },
+            "command": request.command,
+            "Latency": seconds * 1000,
+            "DBOperations": len(request.operations),
+            "DBLatency": sum(op[-1] for op in request.operations) * 1000,
+        }
+        print(json.dumps(data, ensure_ascii=False), file=sys.stdout, flush=True)
+
+    def render(self) -> str:
+        """All the metrics in Prometheus text format"""
+        lines = []
+        with self.lock:
+            for name, counter in self.counters.items():
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in counter.items():
+                    lines.append(f"{name}{formatLabels(labels)} {value:g}")
+            for name, histogram in self.histograms.items():
+                lines.append(f"# TYPE {name} histogram")
+                for labels, values in histogram.items():
+                    total = 0.0
+                    for bucket, count in zip(self.buckets, values):
+                        total += count
+                        bucket_labels = labels + (("le", str(bucket)),)
+                        lines.append(
+                            f"{name}_bucket{formatLabels(bucket_labels)} {total:g}"
+                        )
+                    bucket_labels = labels + (("le", "+Inf"),)
+                    lines.append(
+                        f"{name}_bucket{formatLabels(bucket_labels)} {values[-1]:g}"
+                    )
+                    lines.append(f"{name}_sum{formatLabels(labels)} {values[-2]:g}")
+                    lines.append(f"{name}_count{formatLabels(labels)} {values[-1]:g}")
+        return "\n".join(lines) + "\n"
+
+
+def formatLabels(labels: Labels) -> str:
+    """{key="value",...} of Prometheus"""
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+metrics = Metrics()
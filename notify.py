@@ -0,0 +1,107 @@
+import time
+import uuid
+import logging
+from typing import Any
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import settings
+
+
+@dataclass
+class Delivery:
+    """The result of one multicast batch"""
+
+    line_ids: list[str]
+    retry_key: str = field(default_factory=lambda: str(uuid.uuid4()))
+    status: str = "pending"  # "pending", "sent", "failed"
+    attempts: int = 0
+    error: str = ""
+
+
+class Notifier:
+    """
+    Outbound notification queue.
+
+    The recipients are split into batches of LINE multicast limit (500)
+    and sent by the worker threads, so the webhook doesn't wait for them.
+
+    Use case:
+    ```
+    notifier.multicast(line_bot_api, line_ids, TextSendMessage(text="hi"))
+    ```
+    """
+
+    logger = logging.getLogger("attendence.notify")
+    batch_size = 500  # LINE multicast limit
+    max_attempts = 5
+    backoff = 1.0  # seconds, doubled at each retry if no Retry-After
+
+    def __init__(self, workers: int):
+        self.executor = (
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notify")
+            if workers
+            else None
+        )
+        self.deliveries: deque[Delivery] = deque(maxlen=1000)  # recent results
+
+    def multicast(
+        self, line_bot_api: Any, line_ids: list[str], message: Any
+    ) -> list[Future[Delivery]]:
+        """Queue the message to all line_ids"""
+        futures = []
+        for i in range(0, len(line_ids), self.batch_size):
+            delivery = Delivery(line_ids[i : i + self.batch_size])
+            self.deliveries.append(delivery)
+            if self.executor:
+                future = self.executor.submit(
+                    self.send, line_bot_api, delivery, message
+                )
+            else:  # send in this thread (e.g. Lambda freezes background threads)
+                future = Future()
+                future.set_result(self.send(line_bot_api, delivery, message))
+            futures.append(future)
+        return futures
+
+    def send(self, line_bot_api: Any, delivery: Delivery, message: Any) -> Delivery:
+        """Send one batch, retry after the time LINE asked when rate limited (429)"""
+        from linebot.exceptions import LineBotApiError
+
+        while True:
+            delivery.attempts += 1
+            try:
+                line_bot_api.multicast(
+                    delivery.line_ids, message, retry_key=delivery.retry_key
+                )
+                delivery.status = "sent"
+            except LineBotApiError as e:
+                if e.status_code == 409:  # accepted by the previous attempt
+                    delivery.status = "sent"
+                elif e.status_code == 429 and delivery.attempts < self.max_attempts:
+                    wait = self.retryAfter(e.headers, delivery.attempts)
+                    self.logger.info(f"Rate limited, retry after {wait}s")
+                    time.sleep(wait)
+                    continue
+                else:
+                    delivery.status = "failed"
+                    delivery.error = str(e)
+            except Exception as e:
+                delivery.status = "failed"
+                delivery.error = str(e)
+            self.logger.info(
+                f"Multicast {len(delivery.line_ids)} users: {delivery.status} "
+                f"(attempts={delivery.attempts}) {delivery.error}"
+            )
+            return delivery
+
+    def retryAfter(self, headers: Any, attempts: int) -> float:
+        """Seconds to wait before the next attempt"""
+        headers = {key.lower(): value for key, value in dict(headers or {}).items()}
+        try:
+            return float(headers["retry-after"])
+        except (KeyError, ValueError):
+            return self.backoff * 2 ** (attempts - 1)
+
+
+notifier = Notifier(settings.notify_workers)
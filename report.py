@@ -24,9 +24,19 @@ class Report(Base):
         team: str
         end: bool
         questions: [Question]
-        users:
+        stats: bool  # the sets of pending and responded users are kept
+        users:  # deprecated, only in old reports
             [user-id]:
                 answer: json-info
+    [responses-report-id]:  # hash, the index of responded users
+        [user-id]: True
+    [response-report-id-user-id]:
+        answer: json-info
+    [pending-report-id]:  # set, the members (not admins) not responded yet
+    [responded-report-id]:  # set, the members responded
+    ```
+    The sets are kept by addResponse and Team.join/kickUser,
+    so the statistics are read without the whole team.
     """
 
     # def __init__(self, report_id: str):
@@ -35,17 +45,19 @@ class Report(Base):
     @classmethod
     def create(cls, name: str, team: "Team", questions: list[Question]) -> Report:
         """Create method"""
-        return cls.newObject(
+        report = cls.newObject(
             "report-",
             {
                 "end": False,
                 "name": name,
                 "team": team.id,
                 "team_name": team.getName(),
-                "users": {},
                 "questions": [asdict(i) for i in questions],
+                "stats": True,
             },
         )
+        report.db.sadd(report.pendingKey, team.listMemberIds())
+        return report
 
     def getName(self) -> str:
         """Get report name"""
@@ -59,15 +71,76 @@ class Report(Base):
         """Create join question object"""
         return [Question(**q) for q in self["questions"]]
 
+    @property
+    def responsesKey(self) -> str:
+        """The key of responded users (hash)"""
+        return "responses-" + self.id
+
+    def responseKey(self, user_id: str) -> str:
+        """The key of the user's response"""
+        return f"response-{self.id}-{user_id}"
+
+    @property
+    def pendingKey(self) -> str:
+        """The key of the members not responded yet (set)"""
+        return "pending-" + self.id
+
+    @property
+    def respondedKey(self) -> str:
+        """The key of the responded members (set)"""
+        return "responded-" + self.id
+
+    def migrateStats(self) -> None:
+        """Build the sets of pending and responded users for old reports"""
+        if self.object.get("stats"):
+            return
+        from team import Team
+
+        responded = set(self.listResponded())
+        members = set(Team(self.getTeam()).listMemberIds())
+        self.db.sadd(self.respondedKey, list(responded & members))
+        self.db.sadd(self.pendingKey, list(members - responded))
+        self.atomicUpdate(lambda report: report.object.update(stats=True))
+
+    def getStats(self) -> dict[str, int]:
+        """The number of responded and pending members"""
+        self.migrateStats()
+        return {
+            "responded": self.db.scard(self.respondedKey),
+            "pending": self.db.scard(self.pendingKey),
+        }
+
+    def listPending(self) -> list[str]:
+        """List ID of the members not responded yet"""
+        self.migrateStats()
+        return self.db.smembers(self.pendingKey)
+
+    def listResponded(self) -> list[str]:
+        """List ID of responded users"""
+        return [*self.object.get("users", {}), *self.db.hkeys(self.responsesKey)]
+
+    def getResponses(self, user_ids: list[str]) -> dict[str, Any]:
+        """Get response data of the users at once"""
+        keys = [self.responseKey(user_id) for user_id in user_ids]
+        responses = dict(zip(user_ids, self.db.gets(keys)))
+        legacy = self.object.get("users", {})
+        return {
+            user_id: response or legacy.get(user_id, {})
+            for user_id, response in responses.items()
+        }
+
     def getMemberResponse(self, user_id: str) -> Any:
         """Get response data of the user"""
-        return self["users"].get(user_id, {})
+        return self.getResponses([user_id])[user_id]
 
     def addResponse(self, user_id: str, result: Any) -> None:
         """User response to report and save here"""
         if self["end"]:
             raise UserInputError("This report is already closed")
-        self["users"][user_id] = result
+        self.db.set(self.responseKey(user_id), result)
+        self.db.hset(self.responsesKey, user_id, True)
+        self.db.srem(self.pendingKey, [user_id])
+        self.db.sadd(self.respondedKey, [user_id])
 
     def end(self) -> None:
         """End the report"""
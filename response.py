@@ -1,15 +1,24 @@
-from typing import Any
+from typing import Any, Iterable, Iterator
 from datetime import datetime
 from dataclasses import dataclass, field
 
+max_text_length = 5000  # LINE limit of characters per message
+max_messages = 5  # LINE limit of messages per reply
+
 
 @dataclass
 class RespText:
     """Response oridinary text"""
 
     text: str
+    more: list[str] = field(default_factory=list)  # the following messages
     # json: str = ""
 
+    @property
+    def texts(self) -> list[str]:
+        """All the messages"""
+        return [self.text, *self.more]
+
 
 @dataclass
 class RespChoice(RespText):
@@ -19,36 +28,59 @@ class RespChoice(RespText):
 
 
 def jsonToRespText(data: Any) -> RespText:
-    """flatten txt -> RespText"""
-    return RespText(jsonToText(data).strip())
+    """flatten txt -> RespText (split into pages of LINE message limit)"""
+    pages = [page.strip() for page in iterPages(iterText(data))]
+    pages = [page for page in pages if page] or [""]
+    return RespText(pages[0], more=pages[1:])
+
+
+def iterPages(chunks: Iterable[str], size: int = max_text_length) -> Iterator[str]:
+    """Join the text chunks into pages of size (cut at the last line break)"""
+    buffer: list[str] = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        while length > size:
+            text = "".join(buffer)
+            cut = text.rfind("\n", 0, size + 1)
+            if cut <= 0:
+                cut = size
+            yield text[:cut]
+            buffer = [text[cut:]]
+            length = len(buffer[0])
+    if length:
+        yield "".join(buffer)
 
 
 def jsonToText(data: Any, indent: int = 0) -> str:
     """Json -> flatten txt"""
+    return "".join(iterText(data, indent))
+
+
+def iterText(data: Any, indent: int = 0) -> Iterator[str]:
+    """Json -> flatten txt (in chunks)"""
     if isinstance(data, (int, str)):
-        return str(data)
-    if isinstance(data, datetime):
-        return data.strftime("%Y/%m/%d %H:%M")
-    if isinstance(data, dict):
-        txt = ""
+        yield str(data)
+    elif isinstance(data, datetime):
+        yield data.strftime("%Y/%m/%d %H:%M")
+    elif isinstance(data, dict):
         for key, value in data.items():
-            txt += "\n"
-            txt += " " * indent + str(key) + ": "
-            txt += jsonToText(value, indent + 2)
-        return txt
-    if isinstance(data, (list, tuple)):
-        txt = ""
+            yield "\n"
+            yield " " * indent + str(key) + ": "
+            yield from iterText(value, indent + 2)
+    elif isinstance(data, (list, tuple)):
         count = len(data)
         for rank, value in enumerate(data):
-            # txt += " " * indent + jsonToRespText(value, indent + 2) + "\n"
+            # yield " " * indent + jsonToRespText(value, indent + 2) + "\n"
             if isinstance(value, (int, str)):
-                txt += jsonToText(value, indent + 2)
+                yield from iterText(value, indent + 2)
                 count -= 1
                 if count:
-                    txt += ","
+                    yield ","
             else:
-                txt += " " * indent + str(rank) + ". "
-                txt += jsonToText(value, indent + 2)
-                txt += "\n"
-        return txt
-    raise ValueError
+                yield " " * indent + str(rank) + ". "
+                yield from iterText(value, indent + 2)
+                yield "\n"
+    else:
+        raise ValueError
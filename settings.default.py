@@ -8,6 +8,9 @@ ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 ch.setFormatter(formatter)
 logger.addHandler(ch)
+# dump the documents in the debug log of DB (slow, for development only)
+db_log_payload = False
+db_log_payload_max = 2000  # characters
 
 line_token = ""
 line_webhook = ""
@@ -15,12 +18,39 @@ line_your_id = ""  # your lineID (mostly for testing)
 port = 10101
 mode = "prod"  # "prod", "test"
 db = "redis"  # "redis" "object" "dynamodb"
+# "sync": handle the events before replying to webhook
+# "queue": queue the events in DB (redis) and handle them by worker threads
+#          (`python line.py worker` runs the workers only)
+webhook_mode = "sync"
+# threads to handle events (events of the same user are handled in order)
+webhook_workers = 4
+# threads to send multicast (0: send before replying, e.g. on Lambda)
+notify_workers = 4
+# seconds to remember the handled webhook event (skip the redelivered one)
+event_ttl = 86400
+# seconds to keep an unfinished talk (questions asked by bot) since the last message
+talk_ttl = 86400
+# print the metrics of every message in CloudWatch embedded metric format (Lambda)
+# (Prometheus can read them at /metrics)
+metrics_emf = False
+
+# compress the documents larger than codec_threshold bytes in DB
+# "none", "zlib", "zstd" (pip install zstandard)
+codec = "zlib"
+codec_threshold = 512
 
 # redis
 redis_url = f"redis://redis:6379/attendence-{mode}"
 
 # dynamodb
 dynamodb_table = f"attendence-{mode}"
+# "skip": assume the tables exist (create them by `python db.py provision`)
+# "verify": check the tables once per process and create them if not exist
+# "create": try to create the tables at every startup
+dynamodb_provision = "skip"
+# "blob": save data as orjson bytes
+# "native": save data as DynamoDB map, only the updated field is written
+dynamodb_format = "blob"
 dynamodb_other = dict(
     BillingMode="PAY_PER_REQUEST",
     Tags=[
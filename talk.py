@@ -1,5 +1,6 @@
 from typing import Any
 
+import settings
 from db import db_instance
 
 
@@ -22,10 +23,9 @@ class Talk:
     talk.save()
     ```
 
-    Structure:
+    Structure (a hash, expired after `settings.talk_ttl` seconds without message):
     ```
-    [talk-id]: {
-        user: str,
+    [talkstate-id]: {
         keyword: str,
         label: values
     }
@@ -36,8 +36,9 @@ class Talk:
 
     def __init__(self, line_id: str):
         """Init the Talk instance and query from db immediatly"""
-        self.id = "talk-" + line_id
-        self.talk = self.db.get(self.id) or {}
+        self.id = "talkstate-" + line_id
+        self.talk: dict[str, Any] = self.db.hgetall(self.id)
+        self.changed: set[str] = set()  # fields to write in save()
 
     @property
     def keyword(self) -> str:
@@ -45,8 +46,12 @@ class Talk:
         return self.talk.get("keyword", "")
 
     def set(self, key: str, value: Any) -> None:
-        """Set Any value to this object"""
-        self.talk[key] = value
+        """Set Any value to this object (None to remove it)"""
+        if value is None:
+            self.talk.pop(key, None)
+        else:
+            self.talk[key] = value
+        self.changed.add(key)
 
     def get(self, key: str, default: Any = None) -> Any:
         """get Any value to this object"""
@@ -56,11 +61,18 @@ class Talk:
         """Remove this key from DB"""
         if self:
             self.db.delete(self.id)
+        self.talk = {}
+        self.changed.clear()
 
     def save(self) -> None:
-        """Save this instance to DB"""
+        """Save the changed fields to DB and extend the expiry"""
         assert self.talk
-        self.db.set(self.id, self.talk)
+        self.db.hsets(
+            self.id,
+            {key: self.talk.get(key) for key in self.changed},
+            ttl=settings.talk_ttl,
+        )
+        self.changed.clear()
 
     def __bool__(self) -> bool:
         """Whether this talk-key is exists in DB"""
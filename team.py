@@ -5,11 +5,11 @@ from dataclasses import asdict
 from base import Base
 from error import UserInputError
 from question import Question
+from report import Report
 
 
 if TYPE_CHECKING:
     from user import User
-    from report import Report
 
 
 class Token(Base):
@@ -29,15 +29,13 @@ class Token(Base):
     @classmethod
     def create(cls, action: str, data: Any) -> Token:
         """Create token method"""
-        token = cls.newObject(
+        return cls.newObject(
             "token-",
             {
                 "action": action,
                 "data": data,
             },
         )
-        token.save()
-        return token
 
     @property
     def action(self) -> str:
@@ -50,6 +48,52 @@ class Token(Base):
         return self["data"]
 
 
+class Member(Base):
+    """
+    Member of the team (one document per member)
+
+    Structure:
+    ```
+    [member-team_id-user_id]:
+        role: ["admin", "member"],
+        id: str,
+        name: str,
+        line: str,
+        question:
+            學號: str,
+            ...
+        leave: bool
+    ```
+    """
+
+    def __init__(self, team_id: str, user_id: str):
+        super().__init__(f"member-{team_id}-{user_id}")
+        self._default = {
+            "id": user_id,
+            "role": [],
+            "question": {},
+            "leave": True,
+        }
+
+    def join(self, user: "User", admin: bool, member_info: Any = None) -> None:
+        """Join user into team"""
+        role = "admin" if admin else "member"
+        if role in self["role"]:
+            raise UserInputError("You are already a team {role}")
+        self["name"] = user.getName()
+        self["line"] = user.line
+        self["leave"] = False
+        self["role"].append(role)
+        if role == "member":
+            assert member_info
+            self["question"].update(member_info)
+
+    def kick(self) -> None:
+        """Mark the member as kicked"""
+        self["leave"] = True
+        self["role"] = []
+
+
 class Team(Base):
     """
     Team object.
@@ -63,19 +107,18 @@ class Team(Base):
         join_question: list[Question]
         join_admin_token: Token_ID
         join_user_token:  Token_ID
-        users:
-            [user-id]:
-                role: ["admin", "member"],
-                id: str,
-                line: str,
-                question:
-                    學號: str,
-                    ...
         reports:
             [report-id]:
                 id: str,
                 name: str,
                 end: False,
+    [members-team-id]:  # hash, the index of members (not leaved)
+        [user-id]: name
+    ```
+    The members are saved in Member (member-team_id-user_id).
+    (Old teams saved them in users, they are moved at the first access)
+    The members (not admins) joined/kicked are also added/removed in the pending
+    (and responded) sets of the running reports, see Report.
     """
 
     # def __init__(self, team_id: str):
@@ -89,7 +132,6 @@ class Team(Base):
             {
                 "name": name,
                 "join_questions": [asdict(i) for i in questions],
-                "users": {},
                 "reports": {},
             },
         )
@@ -105,51 +147,59 @@ class Team(Base):
         """Get team name"""
         return str(self["name"])
 
+    @property
+    def membersKey(self) -> str:
+        """The key of member index (hash)"""
+        return "members-" + self.id
+
+    def migrateUsers(self) -> None:
+        """Move the users saved in old team document to Member"""
+        if "users" not in self.object:
+            return
+        for user_id, user in self["users"].items():
+            member = Member(self.id, user_id)
+            member._object = user
+            member.save()
+            if not user["leave"]:
+                self.db.hset(self.membersKey, user_id, user["name"])
+        self.atomicUpdate(lambda team: team.object.pop("users", None))
+
     def join(self, user: "User", admin: bool, member_info: Any = None) -> None:
         """Join user into team"""
-        role = "admin" if admin else "member"
-        if user.id in self["users"]:
-            joined_user = self["users"][user.id]
-            if role in joined_user["role"]:
-                raise UserInputError("You are already a team {role}")
-            joined_user["leave"] = False
-            joined_user["role"].append(role)
-        else:
-            self["users"][user.id] = {
-                "id": user.id,
-                "name": user.getName(),
-                "line": user.line,
-                "role": [role],
-                "question": {},
-                "leave": False,
-            }
-
-        if role == "member":
-            assert member_info
-            self["users"][user.id]["question"].update(member_info)
+        self.migrateUsers()
+        member = Member(self.id, user.id)
+        joined = "member" in member["role"]
+        member.atomicUpdate(lambda member: member.join(user, admin, member_info))
+        self.db.hset(self.membersKey, user.id, member["name"])
+        if not admin and not joined:
+            for team_report in self.listReport():
+                report = Report(team_report["id"])
+                # responded before kicked
+                if self.db.hget(report.responsesKey, user.id):
+                    self.db.sadd(report.respondedKey, [user.id])
+                else:
+                    self.db.sadd(report.pendingKey, [user.id])
 
     def getMemberInfo(self, user_id: str) -> Any:
         """Get memeber info of the user"""
-        return self["users"][user_id]["question"]
+        return self.getUser(user_id)["question"]
 
     def generateJoinQuestion(self) -> list[Question]:
         """Create join question object"""
         return [Question(**q) for q in self["join_questions"]]
 
     def addReport(self, report: "Report") -> None:
-        """Add report for the team"""
-        self["reports"][report.id] = {
-            "name": report.getName(),
-            "id": report.id,
-            "end": False,
-        }
+        """Add report for the team (only the report is written)"""
+        self.update(
+            ["reports", report.id],
+            {"name": report.getName(), "id": report.id, "end": False},
+        )
 
     def endReport(self, report_id: str) -> None:
-        """End one of the report"""
-        team_report = self["reports"][report_id]
-        if team_report["end"]:
+        """End one of the report (only the field is written)"""
+        if self["reports"][report_id]["end"]:
             raise UserInputError("This report is already closed")
-        team_report["end"] = True
+        self.update(["reports", report_id, "end"], True)
 
     def listReport(self, filter_end: bool = True) -> list[Any]:
         """List all alive report"""
@@ -161,13 +211,38 @@ class Team(Base):
     def kickUser(self, user_id: str) -> None:
         """Kick user from team"""
         # Should I mark as kicked
-        self["users"][user_id]["leave"] = True
-        self["users"][user_id]["role"] = []
-
-    def listUsers(self) -> list[Any]:
-        """List all users"""
-        return [u for u in self["users"].values() if not u["leave"]]
+        self.migrateUsers()
+        Member(self.id, user_id).atomicUpdate(lambda member: member.kick())
+        self.db.hdel(self.membersKey, user_id)
+        for team_report in self.listReport():
+            report = Report(team_report["id"])
+            self.db.srem(report.pendingKey, [user_id])
+            self.db.srem(report.respondedKey, [user_id])
+
+    def listUserIds(self) -> list[str]:
+        """List ID of users (not leaved)"""
+        self.migrateUsers()
+        return self.db.hkeys(self.membersKey)
+
+    def listMemberIds(self) -> list[str]:
+        """List ID of users with member role (admins don't respond to reports)"""
+        users = self.getUsers(self.listUserIds())
+        return [user_id for user_id, user in users.items() if "member" in user["role"]]
+
+    def listUsers(self, start: int = 0, count: int | None = None) -> list[Any]:
+        """List users (sorted by name), or a page of them"""
+        self.migrateUsers()
+        names = self.db.hgetall(self.membersKey)
+        user_ids = sorted(names, key=lambda user_id: (names[user_id], user_id))
+        user_ids = user_ids[start : None if count is None else start + count]
+        return list(self.getUsers(user_ids).values())
+
+    def getUsers(self, user_ids: list[str]) -> dict[str, Any]:
+        """Get User data in team at once"""
+        self.migrateUsers()
+        members = Member.loadMany([Member(self.id, user_id) for user_id in user_ids])
+        return {member["id"]: member.object for member in members}
 
     def getUser(self, user_id: str) -> Any:
         """Get User data in team"""
-        return self["users"][user_id]
+        return self.getUsers([user_id])[user_id]
@@ -1,13 +1,21 @@
 import re
+import threading
 import pytest
 
 from db import db_instance
-from error import UserInputError
+from base import Base
+from team import Team
+from user import User
+from report import Report
+from talk import Talk
+from history import History
+from error import UserInputError, InternalError
 from command import app
-from response import RespChoice
+from attendence import App
+from response import RespText, RespChoice, jsonToRespText, max_text_length
+from test_budget import recordDB
 import settings
 
-
 if settings.mode != "test":
     exit()
 
@@ -178,3 +186,383 @@ def test_two_team():
     app.handle("linnil1_admin", t.choices[0])
     t = app.handle("linnil1_admin", "at home")
     assert "time" in t.text
+
+
+def test_unit_of_work(monkeypatch):
+    """Each key is loaded once and saved once per handled message"""
+    db_instance.clear()
+    team = Team.create("Test_team1", [])
+    team.save()
+    with recordDB(monkeypatch) as operations:
+        with Base.unitOfWork():
+            assert Team(team.id).getName() == "Test_team1"
+            team_again = Team(team.id)
+            team_again["name"] = "Test_team2"
+            team_again.save()
+            assert ("setsIf", "") not in operations
+    assert operations.count(("get", team.id)) == 1
+    assert operations.count(("setsIf", "")) == 1
+    assert Team(team.id).getName() == "Test_team2"
+
+
+def test_save_conflict():
+    """The saved object is not written if others saved it since it was loaded"""
+    db_instance.clear()
+    team = Team.create("Test_team1", [])
+    team.save()
+    with pytest.raises(InternalError):
+        with Base.unitOfWork():
+            team = Team(team.id)
+            team["name"] = "Test_team2"
+            team.save()
+            # saved by other message (thread) meanwhile
+            other = Team(team.id)
+            thread = threading.Thread(
+                target=other.atomicUpdate,
+                args=[lambda team: team["reports"].update(r=1)],
+            )
+            thread.start()
+            thread.join()
+    team = Team(team.id)
+    assert team.getName() == "Test_team1"
+    assert team["reports"] == {"r": 1}
+
+
+def test_atomic_update():
+    """The update is applied again on the latest object when conflict"""
+    db_instance.clear()
+    team = Team.create("Test_team1", [])
+    team.save()
+    team_a, team_b = Team(team.id), Team(team.id)
+    assert team_a.getName() == team_b.getName() == "Test_team1"
+
+    team_a.atomicUpdate(lambda team: team.__setitem__("name", "Test_team2"))
+    calls = []
+
+    def addReport(team: Team) -> None:
+        calls.append(team.getName())
+        team["reports"]["report-1"] = {"id": "report-1", "name": "4/26", "end": False}
+
+    team_b.atomicUpdate(addReport)
+    assert calls == ["Test_team1", "Test_team2"]
+    team = Team(team.id)
+    assert team.getName() == "Test_team2"
+    assert "report-1" in team["reports"]
+
+
+def test_kick_conflict(monkeypatch):
+    """The document of kicked user saved meanwhile is not overwritten"""
+    db_instance.clear()
+    for text in ["create team", "Test_team1", "學號", "結束"]:
+        resp = app.handle("admin", text)
+    token_user, _ = re.findall(r"(token-.*)", resp.text)
+    for text in ["join team", token_user, "0"]:
+        app.handle("member0", text)
+
+    calls = []
+    leave_team = User.leaveTeam
+
+    def leaveTeam(user: User, team_id: str) -> None:
+        if not calls:  # saved by the message of the kicked user
+            data = db_instance.get(user.id)
+            data["profile"] = {"displayName": "renamed"}
+            data["_version"] += 1
+            db_instance.set(user.id, data)
+        calls.append(team_id)
+        leave_team(user, team_id)
+
+    monkeypatch.setattr(User, "leaveTeam", leaveTeam)
+    app.handle("admin", "kick member")
+    app.handle("admin", "2")  # member0
+    data = db_instance.get("user-member0")
+    assert len(calls) == 2
+    assert data["profile"] == {"displayName": "renamed"}
+    assert data["teams"] == {}
+
+
+def test_update_field():
+    """Only the field is written and the version is increased"""
+    db_instance.clear()
+    team = Team.create("Test_team1", [])
+    team.save()
+    version = db_instance.get(team.id)["_version"]
+    Team(team.id).update(["reports", "report-1"], {"id": "report-1", "end": False})
+    data = db_instance.get(team.id)
+    assert data["reports"]["report-1"]["id"] == "report-1"
+    assert data["_version"] == version + 1
+
+
+def test_update_field_fallback(monkeypatch):
+    """Missing data/parents and the data saved in blob are updated"""
+    db_instance.clear()
+    db_instance.set("team-1", {"name": "blob"})
+    monkeypatch.setattr(settings, "dynamodb_format", "native")
+    db_instance.update("team-1", ["reports", "report-1"], {"end": False})
+    db_instance.update("team-2", ["reports", "report-1"], {"end": True})
+    assert db_instance.get("team-1")["reports"] == {"report-1": {"end": False}}
+    assert db_instance.get("team-1")["name"] == "blob"
+    assert db_instance.get("team-2")["reports"] == {"report-1": {"end": True}}
+
+
+def test_update_conflict(monkeypatch):
+    """The update raises after retrying the conflicts"""
+    from db import updateByVersion
+    from error import InternalError
+
+    db_instance.clear()
+    backend = db_instance.load()
+    monkeypatch.setattr(backend, "setIf", lambda *args: False)
+    with pytest.raises(InternalError):
+        updateByVersion(backend, "team-1", ["name"], "team")
+
+
+def test_team_members():
+    """Members are saved outside the team and listed by pages"""
+    db_instance.clear()
+    team = Team.create("Test_team1", [])
+    # team saved by older version
+    team["users"] = {
+        f"user-{i}": {
+            "id": f"user-{i}",
+            "name": f"name{i}",
+            "line": str(i),
+            "role": ["member"],
+            "question": {},
+            "leave": i == 3,
+        }
+        for i in range(5)
+    }
+    team.save()
+    team = Team(team.id)
+    assert [u["name"] for u in team.listUsers()] == ["name0", "name1", "name2", "name4"]
+    assert [u["name"] for u in team.listUsers(start=1, count=2)] == ["name1", "name2"]
+    assert "users" not in db_instance.get(team.id)
+    team.kickUser("user-1")
+    assert [u["name"] for u in Team(team.id).listUsers()] == ["name0", "name2", "name4"]
+    assert Team(team.id).getUser("user-1")["leave"]
+
+
+def test_update_reports(monkeypatch):
+    """The reports of user's teams are read at once and saved when changed"""
+    db_instance.clear()
+    for i in range(3):
+        app.handle("linnil1_admin", "create team")
+        app.handle("linnil1_admin", f"Test_team{i}")
+        app.handle("linnil1_admin", "結束")
+    user = User("linnil1_admin")
+    team = Team(next(iter(user["teams"])))
+    report = Report.create(name="4/26", team=team, questions=[])
+    report.save()
+    team.addReport(report)
+
+    with recordDB(monkeypatch) as operations:
+        user = User("linnil1_admin")
+        user.updateReports()
+        assert list(user["reports"]) == [report.id]
+        assert operations == [("get", user.id), ("gets", ""), ("setIf", user.id)]
+        operations.clear()
+        User("linnil1_admin").updateReports()
+        assert operations == [("get", user.id), ("gets", "")]
+
+
+def test_talk_ttl(monkeypatch):
+    """Talk writes only the changed fields and expires after talk_ttl"""
+    db_instance.clear()
+    talk = Talk("linnil1_admin")
+    talk.set("keyword", "create team")
+    talk.set("question-name", {"text": "name?"})
+    talk.save()
+    talk = Talk("linnil1_admin")
+    assert talk.keyword == "create team"
+    talk.set("question-name", None)
+    talk.set("answer", 1)
+    # the unchanged field written by others is kept
+    db_instance.hset(talk.id, "keyword", "join team")
+    with recordDB(monkeypatch) as operations:
+        talk.save()
+    assert operations == [("hsets", talk.id)]
+    assert Talk("linnil1_admin").talk == {"keyword": "join team", "answer": 1}
+
+    monkeypatch.setattr(settings, "talk_ttl", -1)
+    talk.set("answer", 2)
+    talk.save()
+    assert not Talk("linnil1_admin")
+
+    # the fields of the expired talk are not back in the next talk
+    monkeypatch.setattr(settings, "talk_ttl", 86400)
+    talk = Talk("linnil1_admin")
+    talk.set("keyword", "join team")
+    talk.save()
+    assert Talk("linnil1_admin").talk == {"keyword": "join team"}
+
+
+def test_resume_step(monkeypatch):
+    """The finished steps (choose team/report) are not re-run at the next message"""
+    db_instance.clear()
+    for i in range(2):
+        app.handle("linnil1_admin", "create team")
+        app.handle("linnil1_admin", f"Test_team{i}")
+        app.handle("linnil1_admin", "結束")
+    t = app.handle("linnil1_admin", "create report")
+    assert isinstance(t, RespChoice)
+    app.handle("linnil1_admin", t.choices[0])
+
+    def fail(*args, **kwargs):  # type: ignore
+        raise AssertionError("step is re-run")
+
+    monkeypatch.setattr(User, "generateTeamQuestion", fail)
+    app.handle("linnil1_admin", "4/26")
+    app.handle("linnil1_admin", "地點")
+    t = app.handle("linnil1_admin", "結束")
+    assert "回報名稱" in t.text
+    monkeypatch.undo()
+
+    t = app.handle("linnil1_admin", "response report")
+    assert "地點" in t.text
+    monkeypatch.setattr(User, "generateReportQuestion", fail)
+    monkeypatch.setattr(Report, "generateQuestion", fail)
+    t = app.handle("linnil1_admin", "home")
+    assert "home" in t.text
+
+
+def test_pages():
+    """Long response is split into messages, the rest are sent by next page"""
+    db_instance.clear()
+    users = [
+        {"姓名": f"name{i:04d}", "權限": ["user"], "加入資料": {"學號": str(i)}}
+        for i in range(2000)
+    ]
+    resp = jsonToRespText(users)
+    assert all(len(text) <= max_text_length for text in resp.texts)
+    assert "name0000" in resp.text and "name1999" in resp.more[-1]
+
+    page_app = App()
+    page_app.addCommand(["list"])(lambda user, context: resp)
+    t = page_app.handle("linnil1_admin", "list")
+    assert isinstance(t, RespChoice) and t.choices == [page_app.next_page]
+    texts = t.texts
+    assert len(texts) == 5
+    while isinstance(t, RespChoice):
+        t = page_app.handle("linnil1_admin", page_app.next_page)
+        texts.extend(t.texts)
+    assert texts == resp.texts
+
+    # other message leaves the pages
+    page_app.handle("linnil1_admin", "list")
+    assert page_app.handle("linnil1_admin", "hi") == RespText("Error")
+
+
+def test_history():
+    """Responses are appended and read by page (with the history saved before)"""
+    db_instance.clear()
+    history = History("report-1", "user-1")
+    history["history"] = [{"i": 0}, {"i": 1}]  # saved in document before
+    history.save()
+    for i in range(2, 5):
+        History("report-1", "user-1").addResponse({"i": i})
+    history = History("report-1", "user-1")
+    assert history.countResponse() == 5
+    assert [r["i"] for r in history.listResponse()] == [0, 1, 2, 3, 4]
+    assert [r["i"] for r in history.listResponse(1, 2)] == [1, 2]
+    assert [r["i"] for r in history.listResponse(3, 10)] == [3, 4]
+    assert [r["i"] for r in history.listResponse(2)] == [2, 3, 4]
+
+
+def test_create_with(monkeypatch):
+    """The key is created with the value at once, retry if the key is used"""
+    import db
+    from types import SimpleNamespace
+
+    db_instance.clear()
+    uuids = iter(["a", "a", "b"])
+    monkeypatch.setattr(db, "uuid", SimpleNamespace(uuid4=lambda: next(uuids)))
+    assert db_instance.createWith("token-", {"action": "1"}) == "token-a"
+    assert db_instance.createWith("token-", {"action": "2"}) == "token-b"
+    assert db_instance.get("token-a")["id"] == "token-a"
+    assert db_instance.get("token-a")["action"] == "1"
+    assert db_instance.get("token-b")["action"] == "2"
+
+
+def test_report_status():
+    """The pending and responded members are kept when responding, joining, kicking"""
+    db_instance.clear()
+    app.handle("admin", "create team")
+    app.handle("admin", "Test_team1")
+    app.handle("admin", "學號")
+    resp = app.handle("admin", "結束")
+    token_user, _ = re.findall(r"(token-.*)", resp.text)
+    for i in range(3):
+        app.handle(f"member{i}", "join team")
+        app.handle(f"member{i}", token_user)
+        app.handle(f"member{i}", str(i))
+    app.handle("admin", "create report")
+    app.handle("admin", "4/26")
+    app.handle("admin", "地點")
+    app.handle("admin", "結束")
+    app.handle("member0", "response report")
+    app.handle("member0", "home")
+    app.handle("member3", "join team")
+    app.handle("member3", token_user)
+    app.handle("member3", "3")
+    app.handle("admin", "kick member")
+    app.handle("admin", "3")  # member1
+
+    team = Team(next(iter(User("admin")["teams"])))
+    report = Report(next(iter(team["reports"])))
+    assert report.getStats() == {"responded": 1, "pending": 2}
+    assert sorted(report.listPending()) == ["user-member2", "user-member3"]
+    resp = app.handle("admin", "report status")
+    assert "已回報: 1" in resp.text
+    assert "未回報: 2" in resp.text
+
+    # responded, kicked and joined again
+    app.handle("admin", "kick member")
+    app.handle("admin", "2")  # member0
+    assert report.getStats() == {"responded": 0, "pending": 2}
+    for text in ["join team", token_user, "0"]:
+        app.handle("member0", text)
+    assert report.getStats() == {"responded": 1, "pending": 2}
+
+    # report saved by older version
+    report.atomicUpdate(lambda report: report.object.pop("stats"))
+    db_instance.delete(report.pendingKey)
+    db_instance.delete(report.respondedKey)
+    assert Report(report.id).getStats() == {"responded": 1, "pending": 2}
+
+
+def test_lazy_load(monkeypatch):
+    """The backend is created once when threads use it at the same time"""
+    import db
+    import time
+
+    created = []
+
+    class Backend:
+        def __init__(self) -> None:
+            time.sleep(0.01)
+            created.append(self)
+
+        def clear(self) -> None:
+            pass
+
+    monkeypatch.setitem(db.backends, "slow", Backend)
+    lazy = db.LazyDB("slow")
+    threads = [threading.Thread(target=lazy.load) for _ in range(8)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert len(created) == 1
+    assert lazy.load() is created[0]
+
+
+def test_sets():
+    """The members are counted once, removing the missing one changes nothing"""
+    db_instance.clear()
+    db_instance.sadd("pending-1", ["a", "b", "b"])
+    db_instance.sadd("pending-1", ["b", "c"])
+    db_instance.srem("pending-1", ["c", "d"])
+    assert db_instance.scard("pending-1") == 2
+    assert sorted(db_instance.smembers("pending-1")) == ["a", "b"]
+    db_instance.srem("pending-1", ["a", "b"])
+    db_instance.sadd("pending-1", ["e"])
+    assert db_instance.scard("pending-1") == 1
+    assert db_instance.scard("pending-2") == 0
@@ -0,0 +1,106 @@
+import re
+from typing import Any, Iterator
+from contextlib import contextmanager
+
+import pytest
+
+from db import db_instance, LazyDB
+from command import app
+from metrics import metrics
+from response import RespText
+import settings
+
+if settings.mode != "test":
+    exit()
+
+
+READS = {"get", "gets", "hget", "hgetall", "hkeys", "pop", "lrange", "llen"}
+READS |= {"smembers", "scard"}
+WRITES = {"set", "sets", "setIf", "setsIf", "update", "createWith", "delete"}
+WRITES |= {"hset", "hsets", "hdel", "push", "append", "claim", "sadd", "srem"}
+WRITES |= {"ack", "requeue"}
+assert READS | WRITES == LazyDB.operations  # no operation is left uncounted
+
+# the max (reads, writes) of all the messages of the command, for any team size
+BUDGETS = {
+    "create team": (6, 13),
+    "join team": (10, 8),
+    "create report": (8, 10),
+    "response report": (6, 9),
+    "inspect report": (12, 4),
+    "list member": (5, 1),
+    "report status": (8, 1),
+    "remind report": (5, 1),
+    "leave team": (4, 6),
+    "end report": (4, 3),
+    "kick member": (10, 8),
+}
+
+
+@contextmanager
+def recordDB(monkeypatch: Any) -> Iterator[list[tuple[str, str]]]:
+    """Record the DB operations (and their keys) issued inside"""
+    operations: list[tuple[str, str]] = []
+    observe = metrics.observeDB
+
+    def observeDB(backend: str, operation: str, key: str, seconds: float) -> None:
+        operations.append((operation, key))
+        observe(backend, operation, key, seconds)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(metrics, "observeDB", observeDB)
+        yield operations
+
+
+def run(
+    monkeypatch: Any, line_id: str, texts: list[str]
+) -> tuple[tuple[int, int], RespText]:
+    """Send the messages of one command, return the number of reads and writes"""
+    with recordDB(monkeypatch) as operations:
+        for text in texts:
+            resp = app.handle(line_id, text)
+    assert {operation for operation, _ in operations} <= READS | WRITES
+    reads = sum(operation in READS for operation, _ in operations)
+    writes = sum(operation in WRITES for operation, _ in operations)
+    return (reads, writes), resp
+
+
+@pytest.mark.parametrize("size", [1, 10, 50])
+def test_budget(monkeypatch, size):
+    """The DB operations of each command do not grow with the team"""
+    db_instance.clear()
+    cost = {}
+    # the team: admin + members (size) + leaver,
+    # the commands of the last member are measured
+    cost["create team"], resp = run(
+        monkeypatch, "admin", ["create team", "Test_team1", "學號", "結束"]
+    )
+    token_user, _ = re.findall(r"(token-.*)", resp.text)
+    for i in range(size - 1):
+        run(monkeypatch, f"member{i}", ["join team", token_user, str(i)])
+    run(monkeypatch, "leaver", ["join team", token_user, "0"])
+    cost["join team"], _ = run(monkeypatch, "member", ["join team", token_user, "123"])
+
+    cost["create report"], _ = run(
+        monkeypatch, "admin", ["create report", "4/26", "地點", "結束"]
+    )
+    for i in range(size - 1):
+        run(monkeypatch, f"member{i}", ["response report", "home"])
+    cost["response report"], _ = run(monkeypatch, "member", ["response report", "home"])
+    cost["inspect report"], resp = run(monkeypatch, "admin", ["inspect report", "全部"])
+    assert resp.text.count("地點: home") == size
+    cost["list member"], _ = run(monkeypatch, "admin", ["list member"])
+    cost["report status"], resp = run(monkeypatch, "admin", ["report status"])
+    assert f"已回報: {size}" in resp.text
+    cost["remind report"], resp = run(monkeypatch, "admin", ["remind report"])
+    assert "未回報: 1" in resp.text  # leaver
+
+    # while the report is running (the members in report status are removed)
+    cost["leave team"], _ = run(monkeypatch, "leaver", ["leave team"])
+    cost["kick member"], resp = run(monkeypatch, "admin", ["kick member", "2"])
+    assert "member" in resp.text
+    cost["end report"], _ = run(monkeypatch, "admin", ["end report"])
+    assert cost.keys() == BUDGETS.keys()
+    for command, budget in BUDGETS.items():
+        reads, writes = cost[command]
+        assert reads <= budget[0] and writes <= budget[1], command
@@ -0,0 +1,46 @@
+import orjson
+import pytest
+
+from codec import encode, decode, PLAIN, ZLIB
+import settings
+
+if settings.mode != "test":
+    exit()
+
+
+def team(members: int) -> dict:
+    """A team-like document"""
+    return {
+        "id": "team-0a1b",
+        "name": "Test_team1",
+        "users": {
+            f"user-U{i:032x}": {"name": f"name{i}", "role": ["user"], "question": {}}
+            for i in range(members)
+        },
+        "_version": 3,
+    }
+
+
+def test_codec(monkeypatch):
+    """Large values are compressed, all the formats are readable"""
+    small, large = team(1), team(200)
+    assert encode(small)[:1] == PLAIN
+    assert encode(large)[:1] == ZLIB
+    assert len(encode(large)) < len(orjson.dumps(large)) / 3
+    assert decode(encode(small)) == small
+    assert decode(encode(large)) == large
+    # saved before the codec
+    assert decode(orjson.dumps(large)) == large
+    assert decode(orjson.dumps(large).decode()) == large
+
+    monkeypatch.setattr(settings, "codec", "none")
+    assert encode(large)[:1] == PLAIN
+
+
+def test_codec_zstd(monkeypatch):
+    """zstd with the same dictionary"""
+    pytest.importorskip("zstandard")
+    monkeypatch.setattr(settings, "codec", "zstd")
+    large = team(200)
+    assert len(encode(large)) < len(orjson.dumps(large)) / 3
+    assert decode(encode(large)) == large
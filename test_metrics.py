@@ -0,0 +1,45 @@
+import json
+
+from db import db_instance
+from command import app
+from metrics import metrics
+import settings
+
+if settings.mode != "test":
+    exit()
+
+
+def test_metrics():
+    """Messages and DB operations are labeled by the command"""
+    db_instance.clear()
+    metrics.clear()
+    app.handle("linnil1_admin", "create team")
+    app.handle("linnil1_admin", "Test_team1")
+    app.handle("linnil1_admin", "結束")
+
+    commands = metrics.counters["attendence_commands_total"]
+    assert commands[(("command", "create team"),)] == 3
+    operations = metrics.counters["attendence_db_operations_total"]
+    labels = dict(
+        (dict(label)["operation"], dict(label)["key"])
+        for label in operations
+        if dict(label)["command"] == "create team"
+    )
+    assert labels["hgetall"] == "talkstate"
+
+    text = metrics.render()
+    assert 'attendence_commands_total{command="create team"} 3' in text
+    assert (
+        'attendence_command_seconds_bucket{command="create team",le="+Inf"} 3' in text
+    )
+    assert 'attendence_db_seconds_count{command="create team",' in text
+
+
+def test_metrics_emf(monkeypatch, capsys):
+    """One EMF line per message"""
+    monkeypatch.setattr(settings, "metrics_emf", True)
+    app.handle("linnil1_admin", "create team")
+    data = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert data["command"] == "create team"
+    assert data["DBOperations"] > 0
+    assert data["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["command"]]
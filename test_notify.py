@@ -0,0 +1,76 @@
+import re
+from unittest.mock import Mock
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error
+
+from notify import Notifier
+from db import db_instance
+from command import app
+import attendence
+import settings
+
+
+if settings.mode != "test":
+    exit()
+
+
+class FakeLineBotApi:
+    """Record multicast and reply 429 at the first call"""
+
+    def __init__(self) -> None:
+        self.sent: list[list[str]] = []
+        self.calls = 0
+
+    def multicast(self, line_ids: list[str], message: str, retry_key: str) -> None:
+        self.calls += 1
+        if self.calls == 1:
+            raise LineBotApiError(429, {"Retry-After": "0"}, error=Error("Too Many"))
+        self.sent.append(line_ids)
+
+
+def test_multicast_batches():
+    """Recipients are sent by 500 per batch and the rate limited one is retried"""
+    line_bot_api = FakeLineBotApi()
+    notifier = Notifier(workers=1)
+    line_ids = [f"U{i:04d}" for i in range(1201)]
+    futures = notifier.multicast(line_bot_api, line_ids, "hi")
+    deliveries = [future.result() for future in futures]
+    assert [len(d.line_ids) for d in deliveries] == [500, 500, 201]
+    assert all(d.status == "sent" for d in deliveries)
+    assert deliveries[0].attempts == 2
+    assert sorted(sum(line_bot_api.sent, [])) == line_ids
+
+
+def test_multicast_failed():
+    """Other errors are recorded in delivery"""
+    line_bot_api = Mock(multicast=Mock(side_effect=ValueError("no")))
+    deliveries = Notifier(workers=0).multicast(line_bot_api, ["U1"], "hi")
+    assert deliveries[0].result().status == "failed"
+
+
+def test_remind_pending(monkeypatch):
+    """Only the members not responded are reminded, all are notified at the end"""
+    db_instance.clear()
+    monkeypatch.setattr(attendence, "notifier", Notifier(workers=0))
+    for text in ["create team", "Test_team1", "學號", "結束"]:
+        resp = app.handle("admin", text)
+    token_user, _ = re.findall(r"(token-.*)", resp.text)
+    for i in range(3):
+        for text in ["join team", token_user, str(i)]:
+            app.handle(f"member{i}", text)
+    for text in ["create report", "4/26", "地點", "結束"]:
+        app.handle("admin", text)
+    for text in ["response report", "home"]:
+        app.handle("member1", text)
+
+    line_bot_api = FakeLineBotApi()
+    resp = app.handle("admin", "remind report", line_bot_api=line_bot_api)
+    assert "未回報: 2" in resp.text
+    assert sorted(sum(line_bot_api.sent, [])) == ["member0", "member2"]
+
+    # all the members are notified when the report ends
+    line_bot_api = FakeLineBotApi()
+    app.handle("admin", "end report", line_bot_api=line_bot_api)
+    all_ids = ["admin", "member0", "member1", "member2"]
+    assert sorted(sum(line_bot_api.sent, [])) == all_ids
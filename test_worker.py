@@ -0,0 +1,133 @@
+import time
+import hmac
+import threading
+import base64
+import hashlib
+from concurrent.futures import wait
+
+import pytest
+
+from db import db_instance
+from worker import EventWorker, Dispatcher
+import settings
+
+if settings.mode != "test":
+    exit()
+
+
+def test_worker():
+    """Queued items are handled by the worker threads"""
+    db_instance.clear()
+    handled = []
+    worker = EventWorker(handled.append, workers=2)
+    worker.start()
+    for i in range(10):
+        worker.put({"i": i})
+    for _ in range(100):
+        if len(handled) == 10:
+            break
+        time.sleep(0.01)
+    worker.stop()
+    assert sorted(item["i"] for item in handled) == list(range(10))
+
+
+def test_worker_processing():
+    """The unfinished items are requeued at start, the failed ones are retried"""
+    db_instance.clear()
+    handled = []
+    failed = []
+
+    def handle(item: dict[str, int]) -> None:
+        if item["i"] == 1 and not failed:
+            failed.append(item)
+            raise ValueError("fail once")
+        handled.append(item["i"])
+
+    worker = EventWorker(handle, workers=1, name="test")
+    # the item popped by the crashed worker of the same name
+    worker.put({"i": 0})
+    assert db_instance.pop(worker.key, processing=worker.processingKey(0))
+    worker.start()
+    worker.put({"i": 1})
+    for _ in range(100):
+        if len(handled) == 2:
+            break
+        time.sleep(0.01)
+    worker.stop()
+    assert handled == [0, 1]
+    assert failed == [{"i": 1}]
+    assert db_instance.pop(worker.processingKey(0), timeout=0) is None
+    assert db_instance.pop(worker.key, timeout=0) is None
+
+
+def test_worker_backend(monkeypatch):
+    """The queue is not run on the DB without queue"""
+    monkeypatch.setattr(settings, "db", "dynamodb")
+    with pytest.raises(ValueError):
+        EventWorker(print, workers=1).start()
+
+
+def test_webhook_queue(monkeypatch):
+    """Webhook replies at once and puts the request on the queue"""
+    import line
+
+    db_instance.clear()
+    monkeypatch.setattr(settings, "webhook_mode", "queue")
+    body = '{"destination": "U0", "events": []}'
+    signature = base64.b64encode(
+        hmac.new(settings.line_webhook.encode(), body.encode(), hashlib.sha256).digest()
+    ).decode()
+    client = line.app.test_client()
+    resp = client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    assert resp.status_code == 200
+    assert db_instance.pop(EventWorker.key) == {"body": body, "signature": signature}
+    resp = client.post("/callback", data=body, headers={"X-Line-Signature": "wrong"})
+    assert resp.status_code == 400
+    assert db_instance.pop(EventWorker.key, timeout=0) is None
+
+
+def test_dispatcher():
+    """Events of different users run in parallel, the same user's run in order"""
+    handled: dict[str, list[int]] = {}
+    threads: set[str] = set()
+
+    def handle(event: tuple[str, int]) -> None:
+        threads.add(threading.current_thread().name)
+        time.sleep(0.01)
+        handled.setdefault(event[0], []).append(event[1])
+
+    dispatcher = Dispatcher(lanes=4)
+    events = [(f"U{user}", i) for i in range(5) for user in range(8)]
+    start = time.time()
+    wait(dispatcher.dispatch(events, key=lambda event: event[0], handle=handle))
+    assert time.time() - start < 0.01 * len(events)
+    assert len(threads) > 1
+    assert handled == {f"U{user}": list(range(5)) for user in range(8)}
+
+
+def test_redelivery(monkeypatch):
+    """The redelivered event (the same webhook event id) is handled once"""
+    import line
+    from linebot.models import MessageEvent
+
+    db_instance.clear()
+    handled = []
+    monkeypatch.setattr(line, "lineHandle", handled.append)
+    event = MessageEvent.new_from_json_dict(
+        {
+            "type": "message",
+            "webhookEventId": "01ABC",
+            "replyToken": "token",
+            "source": {"type": "user", "userId": "U0"},
+            "message": {"type": "text", "id": "1", "text": "hi"},
+            "deliveryContext": {"isRedelivery": False},
+        }
+    )
+    line.handleEvent(event)
+    line.handleEvent(event)
+    assert handled == [event]
+
+    assert db_instance.claim("event-test", 1)
+    assert not db_instance.claim("event-test", 1)
+    db_instance.delete("event-test")
+    assert db_instance.claim("event-test", 1)
@@ -104,12 +104,17 @@ class User(Base):
         return question
 
     def updateReports(self) -> None:
-        """Replace updateUserForReport function"""
+        """
+        Replace updateUserForReport function
+
+        The reports (index) of all the teams are read by one db.gets
+        and the user is saved only if the reports are changed.
+        """
         from team import Team
 
+        teams = Team.loadMany([Team(team_id) for team_id in self["teams"]])
         reports_dict = {}
-        for team_id in self["teams"]:
-            team = Team(team_id)
+        for team in teams:
             reports = team.listReport()
             for report in reports:
                 reports_dict[report["id"]] = {
@@ -119,8 +124,9 @@ class User(Base):
                     "id": report["id"],
                     "end": report["end"],
                 }
-        self["reports"] = reports_dict
-        self.save()
+        if reports_dict != self["reports"]:
+            self["reports"] = reports_dict
+            self.save()
 
     def generateReportQuestion(self, filter_end: bool = False) -> Question:
         """For chooseReport"""
@@ -161,7 +167,7 @@ class User(Base):
 
     def leaveTeam(self, team_id: str) -> None:
         """User leave the team"""
-        del self["teams"][team_id]
+        self["teams"].pop(team_id, None)  # may be applied again by atomicUpdate
         report_ids = []
         for report_id, report in self["reports"].items():
             if report["team"] == team_id:
@@ -0,0 +1,171 @@
+import zlib
+import logging
+import threading
+from typing import Any, Callable
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from db import db_instance, backends
+import settings
+
+
+class EventWorker:
+    """
+    Background workers of the webhook.
+
+    The webhook only puts the (signature verified) request on the queue in DB
+    and replies to LINE at once.
+    The worker threads pop the requests and handle them.
+
+    A popped request is kept in the processing list of the worker until
+    it is handled (handle may return the futures of it), so the requests of
+    a crashed worker are put back to the queue when the worker of the same
+    name starts again. The failed one is queued again (max_attempts).
+
+    Use case:
+    ```
+    worker = EventWorker(handleRequest, workers=4, name="worker")
+    worker.start()
+    worker.put({"body": body, "signature": signature})
+    ```
+    """
+
+    logger = logging.getLogger("attendence.worker")
+    db = db_instance
+    key = "queue-webhook"
+    max_attempts = 3
+
+    def __init__(
+        self, handle: Callable[[Any], Any], workers: int, name: str = "worker"
+    ):
+        self.handle = handle
+        self.workers = workers
+        self.name = name
+        self.threads: list[threading.Thread] = []
+        self.stopped = threading.Event()
+
+    def put(self, item: Any) -> None:
+        """Queue the item to be handled"""
+        self.db.push(self.key, item)
+
+    @classmethod
+    def checkBackend(cls) -> None:
+        """The queue is in DB, raise if the DB (e.g. DynamoDB) has no queue"""
+        if not hasattr(backends[settings.db], "push"):
+            raise ValueError(
+                f'webhook_mode = "queue" needs redis (or object) DB, not {settings.db}'
+            )
+
+    def processingKey(self, index: int) -> str:
+        """The key of the requests handling by the worker thread"""
+        return f"{self.key}-processing-{self.name}-{index}"
+
+    def start(self) -> None:
+        """Start the worker threads (after requeuing the unfinished requests)"""
+        self.checkBackend()
+        self.stopped.clear()
+        for i in range(self.workers):
+            if count := self.db.requeue(self.processingKey(i), self.key):
+                self.logger.warning(f"Requeue {count} unfinished requests")
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self.run, args=[i], name=f"worker-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self) -> None:
+        """Stop the worker threads (after their current item)"""
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self, index: int = 0) -> None:
+        """Handle the items in queue until stopped"""
+        processing = self.processingKey(index)
+        while not self.stopped.is_set():
+            item = self.db.pop(self.key, timeout=1, processing=processing)
+            if item is None:
+                continue
+            try:
+                futures = self.handle(item) or []
+            except Exception:
+                self.logger.exception(f"Failed to handle {item}")
+                self.finish(processing, item, failed=True)
+                continue
+            self.finishWhenDone(processing, item, futures)
+
+    def finishWhenDone(
+        self, processing: str, item: Any, futures: list[Future[Any]]
+    ) -> None:
+        """Finish the item after all of its futures are done (not waiting here)"""
+        if not futures:
+            self.finish(processing, item, failed=False)
+            return
+        lock = threading.Lock()
+        remain = [len(futures)]
+
+        def done(_: Future[Any]) -> None:
+            with lock:
+                remain[0] -= 1
+                if remain[0]:
+                    return
+            failed = any(future.exception() for future in futures)
+            self.finish(processing, item, failed=failed)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def finish(self, processing: str, item: Any, failed: bool) -> None:
+        """Remove the item from processing list (queue it again if failed)"""
+        if failed:
+            attempts = item.get("attempts", 0) + 1
+            if attempts < self.max_attempts:
+                self.db.push(self.key, {**item, "attempts": attempts})
+            else:
+                self.logger.error(f"Drop {item} after {attempts} attempts")
+        self.db.ack(processing, item)
+
+
+class Dispatcher:
+    """
+    Handle the events in parallel but keep the order of the events of the same key.
+
+    The events of the same key (LINE user) always run in the same lane
+    (a single thread), the lanes run in parallel.
+    Talk state is read-modify-write so a user's messages cannot be reordered.
+    """
+
+    logger = logging.getLogger("attendence.worker")
+
+    def __init__(self, lanes: int):
+        self.lanes = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"lane-{i}")
+            for i in range(max(lanes, 1))
+        ]
+
+    def dispatch(
+        self,
+        events: list[Any],
+        key: Callable[[Any], str],
+        handle: Callable[[Any], None],
+    ) -> list[Future[None]]:
+        """Queue the events in their lanes"""
+        return [
+            self.lane(key(event)).submit(self.run, handle, event) for event in events
+        ]
+
+    def lane(self, key: str) -> ThreadPoolExecutor:
+        """The lane of the key"""
+        return self.lanes[zlib.crc32(key.encode()) % len(self.lanes)]
+
+    def run(self, handle: Callable[[Any], None], event: Any) -> None:
+        """
+        Handle the event and log the error (the other events keep going),
+        the error is kept in its future
+        """
+        try:
+            handle(event)
+        except Exception:
+            self.logger.exception(f"Failed to handle {event}")
+            raise